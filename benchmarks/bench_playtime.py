@@ -0,0 +1,131 @@
+# Checks how well playtime adds up over many short rounds, comparing the old
+# datetime based timer of uneventeams.py with the current playtimes registry.
+#
+#     python benchmarks/bench_playtime.py [--rounds N] [--length SECONDS] [--tolerance SECONDS]
+#
+# Every round starts the timers of a full team, sleeps for the round length and
+# stops them again. The expected playtime is measured with time.monotonic().
+# Before that the registry is driven with explicit times and the totals and the
+# order of tied players are checked exactly. The script exits with 1 if that
+# check fails or the playtimes error exceeds the tolerance.
+
+import argparse
+import datetime
+import sys
+import time
+
+import minqlx
+
+class oldtimer():
+    '''The timer class of uneventeams.py before the playtimes registry.'''
+    def __init__(self):
+        self._started = None
+        self._running = False
+        self._elapsed = 0
+    
+    def start(self):
+        if self._running:
+            return
+        self._started = datetime.datetime.now()
+        self._running = True
+    
+    def stop(self):
+        if not self._started or not self._running:
+            return
+        diff = datetime.datetime.now() - self._started
+        self._elapsed += diff.seconds
+        self._running = False
+    
+    def elapsed(self):
+        if self._running:
+            now = datetime.datetime.now()
+            self._elapsed += (now - self._started).seconds
+            self._started = now
+        return self._elapsed
+
+def check(playtimes):
+    '''Drives a registry with explicit times, returns a list of problems.'''
+    registry = playtimes()
+    team = [1, 2, 3, 4]
+    for sid in team + [5]:
+        registry.add(sid, "red")
+    
+    problems = []
+    expected, now = 0.0, 100.0
+    for length in (0.1, 2.5, 0.03, 17.0, 0.7) * 20:
+        registry.start_many(team, now)
+        registry.stop_many(team, now + length)
+        expected += (now + length) - now
+        now += length + 1.0
+    # Player 5 missed the first round only.
+    registry.start_many([5], now)
+    registry.stop_many([5], now + expected - 0.1)
+    
+    for sid in team:
+        if registry.elapsed(sid) != expected:
+            problems.append("{}: {!r} instead of {!r}".format(sid, registry.elapsed(sid), expected))
+    if registry.least("red") != 5:
+        problems.append("least: {} instead of 5".format(registry.least("red")))
+    registry.credit(5, 0.1)
+    # Ties go to the player who joined last, or to the lowest tiebreak.
+    if registry.least("red") != 5:
+        problems.append("least of tied: {} instead of 5".format(registry.least("red")))
+    if registry.least("red", tiebreak=lambda sid: sid) != 1:
+        problems.append("least with tiebreak: {} instead of 1".format(registry.least("red", tiebreak=lambda sid: sid)))
+    order = [sid for sid, elapsed in registry.ordered("red")]
+    if order != [5, 4, 3, 2, 1]:
+        problems.append("order: {} instead of [5, 4, 3, 2, 1]".format(order))
+    
+    # A running timer counts up to the given time.
+    registry.start_many(team, now)
+    if registry.elapsed(1, now + 2.0) != expected + 2.0:
+        problems.append("running: {!r} instead of {!r}".format(registry.elapsed(1, now + 2.0), expected + 2.0))
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--length", type=float, default=0.01, help="round length in seconds")
+    parser.add_argument("--players", type=int, default=8)
+    parser.add_argument("--tolerance", type=float, default=0.001, help="max error of playtimes per round in seconds")
+    args = parser.parse_args()
+    
+    module = minqlx.load_plugin("uneventeams").__class__.__module__
+    playtimes = __import__(module, fromlist=["playtimes"]).playtimes
+    problems = check(playtimes)
+    for problem in problems:
+        print("check failed: {}".format(problem))
+    
+    registry = playtimes()
+    ids = list(range(args.players))
+    old = {sid: oldtimer() for sid in ids}
+    for sid in ids:
+        registry.add(sid)
+    
+    expected = 0.0
+    for _ in range(args.rounds):
+        start = time.monotonic()
+        registry.start_many(ids)
+        for t in old.values():
+            t.start()
+        time.sleep(args.length)
+        for t in old.values():
+            t.stop()
+        registry.stop_many(ids)
+        expected += time.monotonic() - start
+    
+    new_error = max(abs(registry.elapsed(sid) - expected) for sid in ids)
+    old_error = max(abs(old[sid].elapsed() - expected) for sid in ids)
+    spread = max(registry.elapsed(sid) for sid in ids) - min(registry.elapsed(sid) for sid in ids)
+    print("rounds: {}, expected playtime: {:.3f}s".format(args.rounds, expected))
+    print("old timer: {:.3f}s, max error {:.3f}s".format(old[ids[0]].elapsed(), old_error))
+    print("playtimes: {:.3f}s, max error {:.6f}s, spread within team {:.6f}s".format(
+        registry.elapsed(ids[0]), new_error, spread))
+    if new_error > args.tolerance * args.rounds:
+        print("playtimes error exceeds the tolerance of {}s per round".format(args.tolerance))
+        problems.append(new_error)
+    if problems:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
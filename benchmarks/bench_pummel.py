@@ -0,0 +1,76 @@
+# Measures !pummel latency against the amount of victims stored for a player.
+#
+#     python benchmarks/bench_pummel.py [--rtt MS]
+#
+# "old" is the original implementation that walks the whole :pummeled set and
+# asks REDIS for every victim that is on the server, "new" is the current one.
+
+import argparse
+import statistics
+import time
+
+import minqlx
+
+PLAYER_KEY = "minqlx:players:{}"
+
+def old_cmd_pummel(self, player, msg, channel):
+    pummels = self.db.smembers(PLAYER_KEY.format(player.steam_id) + ":pummeled")
+    players = self.teams()["spectator"] + self.teams()["red"] + self.teams()["blue"] + self.teams()["free"]
+    
+    msg = ""
+    for p in pummels:
+        for pl in players:
+            if p == str(pl.steam_id):
+                count = self.db[PLAYER_KEY.format(player.steam_id) + ":pummeled:" + p]
+                msg +=  pl.name + ": ^1" + count + "^7 "
+    if msg == "":
+        self.msg("{} has not pummeled anybody on this server.".format(player))
+    else:
+        self.msg("Pummel Stats for {}:".format(player))
+        self.msg(msg)
+
+def setup(victims, online):
+    minqlx.server.reset()
+    db = minqlx.server.db
+    killer_id = 76561190000000000
+    for i in range(victims):
+        victim_id = killer_id + 1 + i
+        db.store.setdefault(PLAYER_KEY.format(killer_id) + ":pummeled", set()).add(str(victim_id))
+        db.store[PLAYER_KEY.format(killer_id) + ":pummeled:" + str(victim_id)] = str(i % 7 + 1)
+    
+    plugin = minqlx.load_plugin("pummel")
+    killer = minqlx.server.connect(killer_id, "killer", "red")
+    for i in range(online):
+        minqlx.server.connect(killer_id + 1 + i * max(1, victims // online), "p{}".format(i), ("red", "blue")[i % 2])
+    # Wait for the background prefetch, we want to measure the command itself.
+    time.sleep(0.2)
+    minqlx.unload_plugin("pummel")
+    return plugin, killer
+
+def measure(func, plugin, killer, repeat):
+    samples = []
+    for _ in range(repeat):
+        plugin._counts.clear()
+        before = minqlx.server.db.roundtrips
+        start = time.perf_counter()
+        func(plugin, killer, ["!pummel"], minqlx.CHAT_CHANNEL)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1000, minqlx.server.db.roundtrips - before
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rtt", type=float, default=0.0, help="simulated REDIS round-trip in ms")
+    parser.add_argument("--online", type=int, default=15, help="other players on the server")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    
+    print("{:>8} {:>12} {:>10} {:>12} {:>10}".format("victims", "old ms", "old rt", "new ms", "new rt"))
+    for victims in (10, 1000, 100000):
+        plugin, killer = setup(victims, args.online)
+        minqlx.server.db.latency = args.rtt / 1000
+        old_ms, old_rt = measure(old_cmd_pummel, plugin, killer, args.repeat)
+        new_ms, new_rt = measure(type(plugin).cmd_pummel, plugin, killer, args.repeat)
+        print("{:>8} {:>12.3f} {:>10} {:>12.3f} {:>10}".format(victims, old_ms, old_rt, new_ms, new_rt))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+# Compares the queue/AFK bookkeeping of the original list-of-dicts
+# implementation with the current one for 16, 64 and 1000 entries.
+#
+#     python benchmarks/bench_queue.py
+#
+# Every round adds all players, flags half of them for removal, moves the other
+# half to AFK and back, queries membership of everybody and removes them again.
+
+import datetime
+import timeit
+
+import minqlx
+
+class oldqueue():
+    '''The list handling of queue.py before it was keyed by steam_id.'''
+    def __init__(self):
+        self._queue = []
+        self._afk = []
+    
+    def add(self, player, pos=-1):
+        slot = {"name": player.name, "player" : player, "joinTime" : datetime.datetime.now()}
+        if pos == -1:
+            self._queue.append(slot)
+        else:
+            self._queue.insert(pos, slot)
+    
+    def rem(self, player):
+        for item in self._queue:
+            if item["player"] == player:
+                self._queue.remove(item)
+    
+    def remAFK(self, player):
+        for item in self._afk:
+            if item["player"] == player:
+                self._afk.remove(item)
+    
+    def inqueue(self, player):
+        for item in self._queue:
+            if item["player"] == player:
+                return True
+        return False
+    
+    def inafk(self, player):
+        for item in self._afk:
+            if item["player"] == player:
+                return True
+        return False
+    
+    def setRemPending(self, player):
+        for item in self._queue:
+            if item["player"] == player:
+                item["RemPending"] = True
+                item["RemPendingTime"] = datetime.datetime.now()
+    
+    def isRemPending(self, player):
+        for item in self._queue:
+            if item["player"] == player:
+                if "RemPending" in item.keys():
+                    return True
+                else:
+                    return False
+    
+    def setAFK(self, player):
+        if self.isRemPending(player):
+            return False
+        for i in range(len(self._queue)):
+            if self._queue[i]["player"] == player:
+                self._afk.append(self._queue.pop( i ))
+                return True
+        return False
+    
+    def setPlaying(self, player):
+        for i in range(len(self._afk)):
+            if self._afk[i]["player"] == player:
+                self._queue.append(self._afk.pop( i ))
+                return True
+        return False
+
+def workload(q, players):
+    for p in players:
+        q.add(p)
+    half = len(players) // 2
+    for p in players[:half]:
+        q.setRemPending(p)
+    for p in players[half:]:
+        q.setAFK(p)
+    for p in players:
+        q.inqueue(p)
+        q.inafk(p)
+        q.isRemPending(p)
+    for p in players[half:]:
+        q.setPlaying(p)
+    for p in players:
+        q.remAFK(p)
+        q.rem(p)
+
+def main():
+    minqlx.server.reset()
+    new = minqlx.load_plugin("queue")
+    old = oldqueue()
+    
+    print("{:>8} {:>14} {:>14} {:>8}".format("entries", "old us/round", "new us/round", "speedup"))
+    for size in (16, 64, 1000):
+        players = [minqlx.Player(i % minqlx.MAX_CLIENTS, 76561190000000000 + i, "p{}".format(i)) for i in range(size)]
+        number = max(1, 20000 // size)
+        t_old = min(timeit.repeat(lambda: workload(old, players), number=number, repeat=3)) / number
+        t_new = min(timeit.repeat(lambda: workload(new, players), number=number, repeat=3)) / number
+        print("{:>8} {:>14.1f} {:>14.1f} {:>7.1f}x".format(size, t_old * 1e6, t_new * 1e6, t_old / t_new))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,544 @@
+# This is an offline stand-in for the parts of minqlx used by the plugins in
+# this repository. It lets the benchmarks drive the plugins without a running
+# Quake Live server. Nothing in here talks to the network: the database is a
+# plain dict with just enough of the REDIS command set. use_redis() swaps it for
+# a redis-py compatible client instead, e.g. fakeredis or a local redis-server.
+
+# The plugins are imported as "plugins.<name>" just like minqlx does it, so the
+# repository root never ends up on sys.path (queue.py would shadow the standard
+# library module of the same name otherwise).
+
+import collections
+import fnmatch
+import functools
+import importlib
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+import types
+
+RET_NONE = 0
+RET_STOP = 1
+RET_STOP_EVENT = 2
+RET_STOP_ALL = 3
+RET_USAGE = 4
+
+PRI_HIGHEST = 0
+PRI_HIGH = 1
+PRI_NORMAL = 2
+PRI_LOW = 3
+PRI_LOWEST = 4
+
+CS_PLAYERS = 529
+MAX_CLIENTS = 64
+
+class NonexistentPlayerError(Exception):
+    pass
+
+## Frames and Threads
+_frame_tasks = collections.deque()
+_frame_lock = threading.Lock()
+
+def next_frame(func):
+    @functools.wraps(func)
+    def f(*args, **kwargs):
+        with _frame_lock:
+            _frame_tasks.append((func, args, kwargs))
+    return f
+
+def thread(func, force=False):
+    @functools.wraps(func)
+    def f(*args, **kwargs):
+        t = threading.Thread(target=func, args=args, kwargs=kwargs, daemon=True)
+        t.start()
+        return t
+    return f
+
+def delay(time):
+    def wrap(func):
+        @functools.wraps(func)
+        def f(*args, **kwargs):
+            t = threading.Timer(time, next_frame(func), args=args, kwargs=kwargs)
+            t.daemon = True
+            t.start()
+        return f
+    return wrap
+
+def run_frame():
+    '''Runs the tasks queued with next_frame and dispatches the frame event.'''
+    with _frame_lock:
+        tasks = list(_frame_tasks)
+        _frame_tasks.clear()
+    for func, args, kwargs in tasks:
+        func(*args, **kwargs)
+    server.frame += 1
+    dispatch("frame")
+
+## Players and Game
+class Player:
+    def __init__(self, client_id, steam_id, name, team="spectator"):
+        self.id = client_id
+        self.steam_id = steam_id
+        self.name = name
+        self.clean_name = name
+        self.team = team
+        self.clan = ""
+        self.health = 100
+        self.score = 0
+        self.messages = []
+    
+    def __eq__(self, other):
+        if isinstance(other, Player):
+            return self.steam_id == other.steam_id
+        return self.steam_id == other
+    
+    def __hash__(self):
+        return hash(self.steam_id)
+    
+    def __str__(self):
+        return self.name
+    
+    def __repr__(self):
+        return "Player({}:{})".format(self.id, self.name)
+    
+    def put(self, team):
+        server.switch_team(self, team)
+    
+    def tell(self, msg):
+        self.messages.append(msg)
+    
+    @classmethod
+    def all_players(cls):
+        server.engine_calls += 1
+        return [p for p in server.slots if p is not None]
+
+class Game:
+    def __init__(self):
+        self.state = "in_progress"
+        self.type_short = "ca"
+        self.teamsize = 8
+
+class Channel:
+    def __init__(self, name="chat"):
+        self.name = name
+        self.replies = []
+    
+    def reply(self, msg):
+        self.replies.append(msg)
+
+CHAT_CHANNEL = Channel("chat")
+
+## Database
+class Redis:
+    '''A dict backed subset of the REDIS API, counting round-trips.'''
+    def __init__(self):
+        self.store = {}
+        self.roundtrips = 0
+        # Simulated network latency per round-trip in seconds
+        self.latency = 0
+        self.lock = threading.RLock()
+        self.subscribers = []
+    
+    def roundtrip(self):
+        self.roundtrips += 1
+        if self.latency:
+            time.sleep(self.latency)
+    
+    def _call(self, name, *args, **kwargs):
+        with self.lock:
+            self.roundtrip()
+            return getattr(self, "_" + name)(*args, **kwargs)
+    
+    def __getattr__(self, name):
+        if hasattr(type(self), "_" + name):
+            return functools.partial(self._call, name)
+        raise AttributeError(name)
+    
+    def __contains__(self, key):
+        return self._call("exists", key)
+    
+    def __getitem__(self, key):
+        value = self._call("get", key)
+        if value is None:
+            raise KeyError(key)
+        return value
+    
+    def __setitem__(self, key, value):
+        self._call("set", key, value)
+    
+    def __delitem__(self, key):
+        self._call("delete", key)
+    
+    def pipeline(self, transaction=True):
+        return Pipeline(self)
+    
+    def has_permission(self, player, level=5):
+        return True
+    
+    def pubsub(self, ignore_subscribe_messages=False):
+        pubsub = PubSub(self)
+        self.subscribers.append(pubsub)
+        return pubsub
+    
+    # Commands
+    def _exists(self, key):
+        return key in self.store
+    
+    def _get(self, key):
+        value = self.store.get(key)
+        return None if value is None else str(value)
+    
+    def _set(self, key, value, ex=None):
+        self.store[key] = str(value)
+        return True
+    
+    def _mget(self, keys):
+        return [self._get(key) for key in keys]
+    
+    def _delete(self, *keys):
+        return sum(1 for key in keys if self.store.pop(key, None) is not None)
+    
+    def _expire(self, key, seconds):
+        return key in self.store
+    
+    def _incrby(self, key, amount=1):
+        value = int(self.store.get(key, 0)) + amount
+        self.store[key] = str(value)
+        return value
+    
+    def _incr(self, key, amount=1):
+        return self._incrby(key, amount)
+    
+    def _sadd(self, key, *values):
+        s = self.store.setdefault(key, set())
+        before = len(s)
+        s.update(str(v) for v in values)
+        return len(s) - before
+    
+    def _smembers(self, key):
+        return set(self.store.get(key, ()))
+    
+    def _srem(self, key, *values):
+        s = self.store.get(key, set())
+        before = len(s)
+        s.difference_update(str(v) for v in values)
+        if not s:
+            self.store.pop(key, None)
+        return before - len(s)
+    
+    def _hget(self, key, field):
+        return self.store.get(key, {}).get(str(field))
+    
+    def _hmget(self, key, fields):
+        h = self.store.get(key, {})
+        return [h.get(str(field)) for field in fields]
+    
+    def _hgetall(self, key):
+        return dict(self.store.get(key, {}))
+    
+    def _hset(self, key, field=None, value=None, mapping=None):
+        h = self.store.setdefault(key, {})
+        mapping = dict(mapping or {})
+        if field is not None:
+            mapping[field] = value
+        added = sum(1 for f in mapping if str(f) not in h)
+        h.update((str(f), str(v)) for f, v in mapping.items())
+        return added
+    
+    def _hincrby(self, key, field, amount=1):
+        h = self.store.setdefault(key, {})
+        value = int(h.get(str(field), 0)) + amount
+        h[str(field)] = str(value)
+        return value
+    
+    def _rename(self, src, dst):
+        self.store[dst] = self.store.pop(src)
+        return True
+    
+    def _zincrby(self, key, amount, member):
+        z = self.store.setdefault(key, {})
+        z[str(member)] = z.get(str(member), 0.0) + amount
+        return z[str(member)]
+    
+    def _zscore(self, key, member):
+        return self.store.get(key, {}).get(str(member))
+    
+    def _zrevrange(self, key, start, end, withscores=False):
+        z = self.store.get(key, {})
+        members = sorted(z, key=lambda m: z[m], reverse=True)
+        members = members[start:end + 1 if end != -1 else None]
+        if withscores:
+            return [(m, z[m]) for m in members]
+        return members
+    
+    def _info(self, section=None):
+        # Rough estimate of what REDIS would need: every key costs about 50
+        # bytes of overhead besides its contents.
+        used = 0
+        for key, value in self.store.items():
+            used += 50 + len(key)
+            if isinstance(value, dict):
+                used += sum(len(f) + len(str(v)) + 2 for f, v in value.items())
+            elif isinstance(value, (set, list)):
+                used += sum(len(v) + 8 for v in value)
+            else:
+                used += len(value)
+        return {"used_memory": used}
+    
+    def _scan_iter(self, match="*", count=None):
+        return iter([k for k in self.store if fnmatch.fnmatchcase(k, match)])
+    
+    def _lindex(self, key, index):
+        values = self.store.get(key, [])
+        return values[index] if -len(values) <= index < len(values) else None
+    
+    def _lpush(self, key, *values):
+        lst = self.store.setdefault(key, [])
+        for value in values:
+            lst.insert(0, str(value))
+        return len(lst)
+    
+    def _publish(self, channel, message):
+        receivers = [p for p in self.subscribers if channel in p.channels]
+        for pubsub in receivers:
+            pubsub.messages.put({"type": "message", "pattern": None, "channel": channel, "data": message})
+        return len(receivers)
+
+class PubSub:
+    '''Receives what is published on the dict backed database (no keyspace
+    notifications, patterns are accepted and ignored).
+    '''
+    def __init__(self, db):
+        self.db = db
+        self.channels = set()
+        self.messages = queue.Queue()
+    
+    def subscribe(self, *channels):
+        self.channels.update(channels)
+    
+    def psubscribe(self, *patterns):
+        pass
+    
+    def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+    
+    def close(self):
+        if self in self.db.subscribers:
+            self.db.subscribers.remove(self)
+
+class RedisClient:
+    '''Wraps a redis-py compatible client the way minqlx.database.Redis does,
+    counting round-trips like the dict backed database.
+    '''
+    def __init__(self, client):
+        self.r = client
+        self.roundtrips = 0
+        self.latency = 0
+        execute_command = client.execute_command
+        def counted(*args, **kwargs):
+            self.roundtrips += 1
+            return execute_command(*args, **kwargs)
+        client.execute_command = counted
+    
+    def __getattr__(self, name):
+        return getattr(self.r, name)
+    
+    def __contains__(self, key):
+        return self.r.exists(key)
+    
+    def __getitem__(self, key):
+        value = self.r.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+    
+    def __setitem__(self, key, value):
+        self.r.set(key, value)
+    
+    def __delitem__(self, key):
+        self.r.delete(key)
+    
+    def pipeline(self, transaction=True):
+        pipe = self.r.pipeline(transaction=transaction)
+        execute = pipe.execute
+        def counted(*args, **kwargs):
+            self.roundtrips += 1
+            return execute(*args, **kwargs)
+        pipe.execute = counted
+        return pipe
+    
+    def has_permission(self, player, level=5):
+        return True
+
+def use_redis(client=None):
+    '''Replaces the dict backed database with client, fakeredis by default.'''
+    if client is None:
+        import fakeredis
+        client = fakeredis.FakeStrictRedis(decode_responses=True)
+    server.db = RedisClient(client)
+    return server.db
+
+class Pipeline:
+    '''Buffers commands and executes them as a single round-trip.'''
+    def __init__(self, db):
+        self.db = db
+        self.commands = []
+    
+    def __getattr__(self, name):
+        if not hasattr(type(self.db), "_" + name):
+            raise AttributeError(name)
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return queue
+    
+    def execute(self):
+        with self.db.lock:
+            self.db.roundtrip()
+            commands, self.commands = self.commands, []
+            return [getattr(self.db, "_" + name)(*args, **kwargs) for name, args, kwargs in commands]
+
+## Server State
+class Server:
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        self.slots = [None] * MAX_CLIENTS
+        self.cvars = {}
+        self.game = Game()
+        self.db = Redis()
+        self.hooks = collections.defaultdict(list)
+        self.commands = {}
+        self.sounds = []
+        self.frame = 0
+        self.engine_calls = 0
+        with _frame_lock:
+            _frame_tasks.clear()
+        CHAT_CHANNEL.replies = []
+    
+    def connect(self, steam_id, name, team="spectator", client_id=None):
+        '''Connects a player to client_id, or to the first free slot.'''
+        if client_id is None:
+            client_id = self.slots.index(None)
+        elif self.slots[client_id] is not None:
+            raise ValueError("slot {} is taken".format(client_id))
+        player = Player(client_id, steam_id, name, team)
+        self.slots[client_id] = player
+        dispatch("player_connect", player)
+        return player
+    
+    def disconnect(self, player, reason="disconnected"):
+        dispatch("player_disconnect", player, reason)
+        self.slots[player.id] = None
+    
+    def switch_team(self, player, team):
+        old_team, player.team = player.team, team
+        dispatch("team_switch", player, old_team, team)
+
+server = Server()
+
+def dispatch(event, *args):
+    '''Calls the handlers of every plugin hooked to event in priority order.'''
+    for priority, plugin, handler in sorted(server.hooks[event], key=lambda h: h[0]):
+        ret = handler(*args)
+        if ret in (RET_STOP, RET_STOP_EVENT, RET_STOP_ALL):
+            return ret
+
+def command(player, text, channel=CHAT_CHANNEL):
+    '''Runs a chat command like "!q" or "!afk name" as player.'''
+    msg = text.lstrip("!").split()
+    handler = server.commands[msg[0].lower()]
+    return handler(player, msg, channel)
+
+## Plugins
+class Plugin:
+    @property
+    def logger(self):
+        return logging.getLogger(self.__class__.__name__)
+    
+    @property
+    def game(self):
+        return server.game
+    
+    @property
+    def db(self):
+        if not hasattr(self, "_db_instance"):
+            self._db_instance = server.db
+        return self._db_instance
+    
+    def add_hook(self, event, handler, priority=PRI_NORMAL):
+        server.hooks[event].append((priority, self, handler))
+    
+    def add_command(self, name, handler, permission=0, **kwargs):
+        names = name if isinstance(name, tuple) else (name,)
+        for n in names:
+            server.commands[n] = handler
+    
+    def set_cvar_once(self, name, value, flags=0):
+        server.cvars.setdefault(name, str(value))
+    
+    def set_cvar(self, name, value, flags=0):
+        server.cvars[name] = str(value)
+    
+    def get_cvar(self, name, return_type=str):
+        value = server.cvars.get(name)
+        if value is None:
+            return None
+        return return_type(value) if return_type is not str else value
+    
+    @classmethod
+    def players(cls):
+        return Player.all_players()
+    
+    @classmethod
+    def teams(cls, player_list=None):
+        res = {"free": [], "red": [], "blue": [], "spectator": []}
+        for p in (player_list if player_list is not None else cls.players()):
+            res[p.team].append(p)
+        return res
+    
+    @classmethod
+    def player(cls, name):
+        server.engine_calls += 1
+        if isinstance(name, int) and 0 <= name < MAX_CLIENTS:
+            player = server.slots[name]
+            if player is None:
+                raise NonexistentPlayerError("Invalid client ID.")
+            return player
+        for p in server.slots:
+            if p is not None and (p.steam_id == name or p.name == name):
+                return p
+        raise NonexistentPlayerError("Player not found.")
+    
+    @classmethod
+    def find_player(cls, name):
+        return [p for p in cls.players() if name.lower() in p.name.lower()]
+    
+    @classmethod
+    def msg(cls, msg, chat_channel="chat"):
+        CHAT_CHANNEL.reply(msg)
+    
+    @classmethod
+    def play_sound(cls, path, player=None):
+        server.sounds.append(path)
+
+def load_plugin(name):
+    '''Imports plugins.<name> from the repository root and instantiates it.'''
+    if "plugins" not in sys.modules:
+        package = types.ModuleType("plugins")
+        package.__path__ = [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+        sys.modules["plugins"] = package
+    module = importlib.import_module("plugins." + name)
+    return getattr(module, name)()
+
+def unload_plugin(name):
+    dispatch("unload", name)
+    for event in server.hooks:
+        server.hooks[event] = [h for h in server.hooks[event] if h[1].__class__.__name__ != name]
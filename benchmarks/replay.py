@@ -0,0 +1,134 @@
+# Replays a log written by the recorder plugin against queue, pummel and
+# uneventeams and reports the same per-hook latency table as run.py.
+#
+#     python benchmarks/replay.py LOG [--realtime] [--save FILE] [--baseline FILE]
+#
+# By default the events are applied as fast as possible; --realtime keeps the
+# recorded spacing instead. --save writes p50/p99 per handler and the number of
+# REDIS round-trips to a JSON file, --baseline prints them next to the numbers
+# of an earlier --save, so two versions of the plugins can be compared on the
+# same traffic.
+
+import argparse
+import gzip
+import json
+import time
+
+import minqlx
+
+from run import driver
+
+def lines(path):
+    '''
+    Yields the lines of a recording. A batch the recorder was still writing
+    when the server died is cut off and ends the log.
+    '''
+    with gzip.open(path, "rt") as f:
+        try:
+            for line in f:
+                if not line.endswith("\n"):
+                    return
+                yield line
+        except EOFError:
+            return
+
+def read(path, realtime=False):
+    '''
+    Yields the events of a recording in the tuple format of run.py. A frame
+    event is inserted whenever the recorded frame number changes, events
+    referring to players the log never connected are dropped. Players connect
+    to their recorded slot; if the log missed the disconnect of the player who
+    had it, that player is disconnected first.
+    '''
+    online = set()
+    # client_id -> steam_id
+    slots = {}
+    frame = None
+    start = time.perf_counter()
+    for line in lines(path):
+        record = json.loads(line)
+        t, n, event = record[0], record[1], tuple(record[2:])
+        if frame is not None and n != frame:
+            yield ("frame",)
+        frame = n
+        
+        kind = event[0]
+        if kind == "connect":
+            if event[1] in online:
+                continue
+            if len(event) > 3:
+                other = slots.get(event[3])
+                if other is not None:
+                    online.discard(other)
+                    yield ("disconnect", other)
+                slots[event[3]] = event[1]
+            online.add(event[1])
+        elif kind == "disconnect":
+            if event[1] not in online:
+                continue
+            online.discard(event[1])
+            for client_id, sid in list(slots.items()):
+                if sid == event[1]:
+                    del slots[client_id]
+        elif kind in ("team", "command") and event[1] not in online:
+            continue
+        elif kind == "kill" and not (event[1] in online and event[2] in online):
+            continue
+        elif kind == "command" and event[2].lstrip("!").split()[0].lower() not in minqlx.server.commands:
+            continue
+        
+        if realtime:
+            delay = t - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        yield event
+
+def summary(d):
+    res = {"roundtrips": minqlx.server.db.roundtrips, "handlers": {}}
+    for label, samples in d.samples.items():
+        samples = sorted(samples)
+        if samples:
+            res["handlers"][label] = {
+                "calls": len(samples),
+                "p50": samples[len(samples) // 2],
+                "p99": samples[min(len(samples) - 1, int(len(samples) * 0.99))]}
+    return res
+
+def compare(current, baseline):
+    print("{:<38} {:>10} {:>10} {:>10} {:>10}".format("handler", "p50 us", "was", "p99 us", "was"))
+    for label in sorted(set(current["handlers"]) | set(baseline["handlers"])):
+        now = current["handlers"].get(label, {})
+        was = baseline["handlers"].get(label, {})
+        print("{:<38} {:>10} {:>10} {:>10} {:>10}".format(label,
+            *("{:.1f}".format(x[key] * 1e6) if key in x else "-"
+              for key, x in (("p50", now), ("p50", was), ("p99", now), ("p99", was)))))
+    print("REDIS round-trips: {} (was {})".format(current["roundtrips"], baseline["roundtrips"]))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("log")
+    parser.add_argument("--realtime", action="store_true", help="keep the recorded timing")
+    parser.add_argument("--rtt", type=float, default=0.0, help="simulated REDIS round-trip in ms")
+    parser.add_argument("--fakeredis", action="store_true", help="use fakeredis instead of the dict database")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against a JSON file written by --save")
+    parser.add_argument("--check", type=int, default=0, help="check consistency every N events")
+    args = parser.parse_args()
+    
+    minqlx.server.reset()
+    if args.fakeredis:
+        minqlx.use_redis()
+    minqlx.server.db.latency = args.rtt / 1000
+    d = driver(check_every=args.check)
+    d.report(*d.run(read(args.log, args.realtime)))
+    
+    result = summary(d)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(result, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+# Drives queue, pummel and uneventeams with a synthetic stream of events and
+# reports latency percentiles per hook and command as well as the throughput.
+#
+#     python benchmarks/run.py [--events N] [--seed S] [--check N] [--fakeredis]
+#
+# Every --check events and at the end the plugins' own bookkeeping is compared
+# with the server's players (uneventeams.check_consistency()), the script
+# exits with 1 on the first difference.
+#
+# Events are plain tuples, the same ones replay.py reads from recorded logs:
+#
+#     ("connect", steam_id, name, id)   ("disconnect", steam_id)
+#     ("team", steam_id, team)          ("kill", victim_id, killer_id, mod)
+#     ("configstring", index, value)    ("command", steam_id, text)
+#     ("round_countdown", n)            ("round_start", n)
+#     ("round_end", n)                  ("game_end",)
+#     ("frame",)
+
+import argparse
+import collections
+import random
+import sys
+import time
+
+import minqlx
+
+PLUGINS = ("queue", "pummel", "uneventeams")
+
+class driver():
+    '''Feeds events to the stub server and times every handler it calls.'''
+    def __init__(self, plugins=PLUGINS, check_every=0):
+        self.samples = collections.defaultdict(list)
+        self.check_every = check_every
+        self.players = {}
+        self.plugins = [minqlx.load_plugin(name) for name in plugins]
+        for event, hooks in minqlx.server.hooks.items():
+            hooks[:] = [(priority, plugin, self.timed(self.label(handler), handler))
+                        for priority, plugin, handler in hooks]
+        for name, handler in minqlx.server.commands.items():
+            owner = getattr(handler, "__self__", None)
+            label = "{}.!{}".format(type(owner).__name__, name)
+            minqlx.server.commands[name] = self.timed(label, handler)
+    
+    def label(self, handler):
+        owner = getattr(handler, "__self__", None)
+        if owner is not None:
+            return "{}.{}".format(type(owner).__name__, handler.__name__)
+        return "{}.{}".format(handler.__module__.rsplit(".", 1)[-1], handler.__name__)
+    
+    def timed(self, label, handler):
+        samples = self.samples[label]
+        def wrapper(*args):
+            start = time.perf_counter()
+            try:
+                return handler(*args)
+            finally:
+                samples.append(time.perf_counter() - start)
+        return wrapper
+    
+    def apply(self, event):
+        kind = event[0]
+        if kind == "connect":
+            # Recordings made before the slot was recorded lack the id.
+            client_id = event[3] if len(event) > 3 else None
+            self.players[event[1]] = minqlx.server.connect(event[1], event[2], client_id=client_id)
+        elif kind == "disconnect":
+            minqlx.server.disconnect(self.players.pop(event[1]))
+        elif kind == "team":
+            minqlx.server.switch_team(self.players[event[1]], event[2])
+        elif kind == "kill":
+            victim, killer = self.players[event[1]], self.players[event[2]]
+            minqlx.dispatch("kill", victim, killer, {"MOD": event[3]})
+        elif kind == "configstring":
+            minqlx.dispatch("set_configstring", event[1], event[2])
+        elif kind == "command":
+            minqlx.command(self.players[event[1]], event[2])
+        elif kind in ("round_countdown", "round_start", "round_end"):
+            minqlx.dispatch(kind, event[1])
+        elif kind == "game_end":
+            minqlx.dispatch("game_end", {})
+        elif kind == "frame":
+            minqlx.run_frame()
+    
+    def check(self, count):
+        '''Exits if a plugin's bookkeeping differs from the server's players.'''
+        # Not through Plugin.players(), which would count as engine calls.
+        players = [p for p in minqlx.server.slots if p is not None]
+        for plugin in self.plugins:
+            if not hasattr(plugin, "check_consistency"):
+                continue
+            problems = plugin.check_consistency(players)
+            if problems:
+                print("{} inconsistent after {} events:".format(type(plugin).__name__, count))
+                for problem in problems:
+                    print("  " + problem)
+                sys.exit(1)
+    
+    def run(self, events):
+        '''Applies all events, returns the wall time it took without the checks.'''
+        start = time.perf_counter()
+        checking = 0.0
+        count = 0
+        for event in events:
+            self.apply(event)
+            count += 1
+            if self.check_every and count % self.check_every == 0:
+                before = time.perf_counter()
+                self.check(count)
+                checking += time.perf_counter() - before
+        if self.check_every:
+            self.check(count)
+        return count, time.perf_counter() - start - checking
+    
+    def report(self, count, seconds):
+        print("{:<38} {:>8} {:>10} {:>10} {:>10}".format("handler", "calls", "p50 us", "p99 us", "max us"))
+        for label in sorted(self.samples):
+            samples = sorted(self.samples[label])
+            if not samples:
+                continue
+            p50 = samples[len(samples) // 2]
+            p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+            print("{:<38} {:>8} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+                label, len(samples), p50 * 1e6, p99 * 1e6, samples[-1] * 1e6))
+        print("{} events in {:.3f}s, {:.0f} events/s, {} REDIS round-trips".format(
+            count, seconds, count / seconds, minqlx.server.db.roundtrips))
+        # Without roster.py every request was an engine call.
+        frames = max(1, minqlx.server.frame)
+        rs = sys.modules["plugins.roster"].stats
+        print("per frame: {:.2f} roster requests, {:.2f} roster builds, {:.2f} engine calls".format(
+            rs["requests"] / frames, rs["builds"] / frames, minqlx.server.engine_calls / frames))
+        perf = sys.modules["plugins.perf"]
+        for plugin in self.plugins:
+            if hasattr(plugin, "perf_counters"):
+                print("{}: {}".format(type(plugin).__name__, perf.format_counters(plugin.perf_counters())))
+
+def synthetic(count, seed=0, frame_every=10):
+    '''
+    Yields a random but reproducible event stream: players connecting and
+    leaving (at most 64 at a time), switching teams, gauntlet and other kills,
+    player configstring updates, rounds and chat commands.
+    '''
+    rng = random.Random(seed)
+    base = 76561190000000000
+    online = {}
+    slots = list(range(minqlx.MAX_CLIENTS))
+    next_id = 1
+    round_number = 0
+    for i in range(count):
+        if i % frame_every == 0:
+            yield ("frame",)
+        
+        roll = rng.random()
+        if not online or (roll < 0.05 and len(online) < minqlx.MAX_CLIENTS):
+            sid = base + next_id
+            next_id += 1
+            online[sid] = slots.pop(0)
+            yield ("connect", sid, "player{}".format(next_id), online[sid])
+        elif roll < 0.08:
+            sid = rng.choice(list(online))
+            slots.append(online.pop(sid))
+            slots.sort()
+            yield ("disconnect", sid)
+        elif roll < 0.25:
+            yield ("team", rng.choice(list(online)), rng.choice(("red", "blue", "spectator")))
+        elif roll < 0.45 and len(online) > 1:
+            victim, killer = rng.sample(list(online), 2)
+            yield ("kill", victim, killer, rng.choice(("GAUNTLET", "GAUNTLET", "ROCKET", "RAILGUN")))
+        elif roll < 0.85:
+            slot = rng.choice(list(online.values()))
+            yield ("configstring", minqlx.CS_PLAYERS + slot, "n\\player\\t\\{}\\cn\\\\xcn\\".format(rng.randint(0, 3)))
+        elif roll < 0.95:
+            yield ("command", rng.choice(list(online)), rng.choice(("!q", "!pummel", "!afk", "!here", "!playertimes")))
+        else:
+            round_number += 1
+            yield ("round_countdown", round_number)
+            yield ("round_start", round_number)
+            yield ("round_end", round_number)
+            if round_number % 10 == 0:
+                yield ("game_end",)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--check", type=int, default=1000, help="check consistency every N events, 0 to not check")
+    parser.add_argument("--rtt", type=float, default=0.0, help="simulated REDIS round-trip in ms")
+    parser.add_argument("--fakeredis", action="store_true", help="use fakeredis instead of the dict database")
+    args = parser.parse_args()
+    
+    minqlx.server.reset()
+    if args.fakeredis:
+        minqlx.use_redis()
+    minqlx.server.db.latency = args.rtt / 1000
+    d = driver(check_every=args.check)
+    d.report(*d.run(synthetic(args.events, args.seed)))
+
+if __name__ == "__main__":
+    main()
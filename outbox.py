@@ -0,0 +1,139 @@
+# This is a helper module for the plugins in this repository, not a plugin.
+# Copyright (C) 2016 mattiZed (github) aka mattiZed (ql)
+
+# You can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, 
+# either version 3 of the License, or (at your option) any later version.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlx. If not, see <http://www.gnu.org/licenses/>.
+
+# Every channel.reply(), msg() and play_sound() is a server command sent to
+# the clients right away, so a burst of kills or a command answering with
+# several lines means a burst of server commands. The plugins send through
+# this module instead:
+
+#   from . import outbox
+#   outbox.reply(channel, "...")
+#   outbox.msg("...")
+#   outbox.tell(player, "...")
+#   outbox.play_sound("sound/...")
+
+# Everything sent during a frame is collected per channel and sent on the next
+# frame, with as many lines as fit into LIMIT characters joined into a single
+# reply. Each channel may send at most BURST replies at once and RATE per
+# second after that, whatever is left over waits for the following frames
+# (up to BACKLOG lines, the rest is dropped). The same sound for the same
+# player is only played once per frame. It is safe to send from threads.
+
+import minqlx
+import collections
+import threading
+import time
+
+# Characters per reply, about what the engine takes in one server command
+LIMIT = 1000
+# Replies per channel and second
+RATE = 2.0
+BURST = 6
+# Lines a channel may have waiting, more are dropped
+BACKLOG = 50
+
+stats = {"lines": 0, "replies": 0, "dropped": 0, "sounds": 0, "sounds_merged": 0}
+
+class _outgoing():
+    __slots__ = ("send", "lines", "tokens", "stamp")
+    
+    def __init__(self, send):
+        self.send = send
+        self.lines = collections.deque()
+        self.tokens = BURST
+        self.stamp = time.monotonic()
+    
+    def refill(self, now):
+        self.tokens = min(BURST, self.tokens + (now - self.stamp) * RATE)
+        self.stamp = now
+
+# repr(channel) -> _outgoing, kept while a channel is rate limited
+_channels = collections.OrderedDict()
+# (path, steam_id or None) -> player, sounds to play on the next frame
+_sounds = collections.OrderedDict()
+_lock = threading.Lock()
+_scheduled = False
+
+def reply(channel, msg):
+    '''Sends msg to channel on the next frame.'''
+    _add(repr(channel), channel.reply, msg)
+
+def msg(msg):
+    '''Sends msg to everybody's chat on the next frame, like Plugin.msg().'''
+    _add(repr(minqlx.CHAT_CHANNEL), minqlx.CHAT_CHANNEL.reply, msg)
+
+def tell(player, msg):
+    '''Sends msg to player on the next frame, like Player.tell().'''
+    _add("tell {}".format(player.steam_id), player.tell, msg)
+
+def play_sound(path, player=None):
+    '''Plays path on the next frame unless it is already going to be played.'''
+    global _scheduled
+    key = (path, player.steam_id if player else None)
+    with _lock:
+        if key in _sounds:
+            stats["sounds_merged"] += 1
+            return
+        _sounds[key] = player
+        if not _scheduled:
+            _scheduled = True
+            _flush()
+
+def _add(key, send, msg):
+    global _scheduled
+    with _lock:
+        out = _channels.get(key)
+        if out is None:
+            out = _channels[key] = _outgoing(send)
+        if len(out.lines) >= BACKLOG:
+            stats["dropped"] += 1
+            return
+        out.lines.append(str(msg))
+        stats["lines"] += 1
+        if not _scheduled:
+            _scheduled = True
+            _flush()
+
+def _pack(lines):
+    '''Takes as many lines as fit into LIMIT characters (at least one).'''
+    packed = [lines.popleft()]
+    size = len(packed[0])
+    while lines and size + 1 + len(lines[0]) <= LIMIT:
+        size += 1 + len(lines[0])
+        packed.append(lines.popleft())
+    return "\n".join(packed)
+
+@minqlx.next_frame
+def _flush():
+    global _scheduled
+    now = time.monotonic()
+    sends = []
+    with _lock:
+        for key in list(_channels):
+            out = _channels[key]
+            out.refill(now)
+            while out.lines and out.tokens >= 1:
+                out.tokens -= 1
+                sends.append((out.send, _pack(out.lines)))
+            # Channels that are back to a full bucket need no state anymore.
+            if not out.lines and out.tokens >= BURST:
+                del _channels[key]
+        sounds = list(_sounds.items())
+        _sounds.clear()
+        _scheduled = any(out.lines for out in _channels.values())
+        stats["replies"] += len(sends)
+        stats["sounds"] += len(sounds)
+    
+    for send, text in sends:
+        send(text)
+    for (path, steam_id), player in sounds:
+        minqlx.Plugin.play_sound(path, player)
+    if _scheduled:
+        _flush()
@@ -0,0 +1,319 @@
+# This is an extension plugin  for minqlx.
+# Copyright (C) 2016 mattiZed (github) aka mattiZed (ql)
+
+# You can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, 
+# either version 3 of the License, or (at your option) any later version.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlx. If not, see <http://www.gnu.org/licenses/>.
+
+# Measures how much frame time the hooks and commands of queue, pummel and
+# uneventeams cost. Like roster.py this file is also a helper module the other
+# plugins import; their handlers are wrapped with timed() and their database
+# with track():
+
+#   from . import perf
+#   perf.track(self)
+#
+#   @perf.timed
+#   def handle_kill(self, victim, killer, data):
+
+# Nothing is measured unless this file is also loaded as a plugin and
+# qlx_perfEnabled is 1 (or an admin used "!perf on"), until then a timed()
+# handler costs one extra function call and the database of a tracked plugin is
+# left alone, it is only wrapped while measuring. Every handler gets a histogram of its
+# run time with fixed buckets and a count of the REDIS calls it made. "!perf"
+# lists the handlers with the most total time, "!perf <name>" the histogram of
+# one of them. With qlx_perfDumpInterval set the numbers are also appended to
+# qlx_perfDumpPath as one JSON object per line every that many seconds. Both
+# also show how often per frame the plugins asked roster.py for the players
+# and how often it had to ask the engine, each request used to be an engine
+# call before. A tracked plugin can add its own numbers by defining
+# perf_counters(), which returns a dict of them.
+
+import minqlx
+import functools
+import json
+import threading
+import time
+import weakref
+
+from . import outbox
+from . import roster
+
+# Upper bounds of the histogram buckets in microseconds, the last bucket
+# takes everything above.
+BUCKETS = (10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000)
+
+enabled = False
+
+class histogram():
+    __slots__ = ("counts", "calls", "total", "max", "redis")
+    
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.redis = 0
+    
+    def add(self, seconds, redis):
+        us = seconds * 1e6
+        i = 0
+        while i < len(BUCKETS) and us > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.calls += 1
+        self.total += seconds
+        self.redis += redis
+        if seconds > self.max:
+            self.max = seconds
+    
+    def percentile(self, q):
+        '''Upper bound of the bucket holding the q-th percentile in microseconds.'''
+        rank = q * self.calls
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max * 1e6
+        return 0
+    
+    def as_dict(self):
+        return {"calls": self.calls, "total": self.total, "max": self.max,
+                "redis": self.redis, "counts": self.counts}
+
+# "!reload perf" runs this module again in place, the measurements and the
+# tracked plugins are kept.
+
+# Handler name -> histogram
+stats = globals().get("stats", {})
+
+# REDIS calls per thread, read before and after each timed handler.
+_local = threading.local()
+
+def _redis_calls():
+    return getattr(_local, "calls", 0)
+
+def _count():
+    _local.calls = getattr(_local, "calls", 0) + 1
+
+def timed(func):
+    '''Decorator recording the run time and REDIS calls of a hook or command.'''
+    label = func.__qualname__
+    
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not enabled:
+            return func(*args, **kwargs)
+        redis = _redis_calls()
+        start = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.monotonic() - start
+            h = stats.get(label)
+            if h is None:
+                h = stats[label] = histogram()
+            h.add(elapsed, _redis_calls() - redis)
+    return wrapper
+
+class counting():
+    '''Passes everything on to the plugin's database, counting the calls.'''
+    __slots__ = ("_db",)
+    
+    def __init__(self, db):
+        self._db = db
+    
+    def __getattr__(self, name):
+        attr = getattr(self._db, name)
+        if name == "pipeline":
+            return lambda *args, **kwargs: counting_pipeline(attr(*args, **kwargs))
+        if not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            _count()
+            return attr(*args, **kwargs)
+        return call
+    
+    def __contains__(self, key):
+        _count()
+        return key in self._db
+    
+    def __getitem__(self, key):
+        _count()
+        return self._db[key]
+    
+    def __setitem__(self, key, value):
+        _count()
+        self._db[key] = value
+    
+    def __delitem__(self, key):
+        _count()
+        del self._db[key]
+
+class counting_pipeline():
+    '''A pipeline is one call, made when it is executed.'''
+    __slots__ = ("_pipe",)
+    
+    def __init__(self, pipe):
+        self._pipe = pipe
+    
+    def __getattr__(self, name):
+        return getattr(self._pipe, name)
+    
+    def execute(self, *args, **kwargs):
+        _count()
+        return self._pipe.execute(*args, **kwargs)
+
+# Plugins whose database is counted while enabled
+_tracked = globals().get("_tracked", weakref.WeakSet())
+# Plugin -> its database while wrapped
+_originals = globals().get("_originals", weakref.WeakKeyDictionary())
+
+def track(plugin):
+    '''Counts the REDIS calls made through plugin.db while measuring.'''
+    _tracked.add(plugin)
+    if enabled:
+        _wrap(plugin)
+
+def _wrap(plugin):
+    # Wrapped again even if it already is, a wrapper from before a reload
+    # would count into the old module.
+    if plugin not in _originals:
+        _originals[plugin] = plugin.db
+    plugin._db_instance = counting(_originals[plugin])
+
+def _unwrap(plugin):
+    db = _originals.pop(plugin, None)
+    if db is not None:
+        plugin._db_instance = db
+
+def counters():
+    '''Returns {plugin name: perf_counters()} of the tracked plugins having one.'''
+    res = {}
+    for plugin in list(_tracked):
+        report = getattr(plugin, "perf_counters", None)
+        if report is not None:
+            res[type(plugin).__name__] = report()
+    return res
+
+def format_counters(values):
+    '''Formats a perf_counters() dict as one line, nested dicts as name:value.'''
+    parts = []
+    for name, value in values.items():
+        if isinstance(value, dict):
+            value = " ".join("{}:{}".format(k, v) for k, v in value.items() if v) or "-"
+        elif isinstance(value, float):
+            value = "{:.2f}".format(value)
+        parts.append("{} {}".format(name, value))
+    return ", ".join(parts)
+
+def threads():
+    return threading.active_count()
+
+class perf(minqlx.Plugin):
+    def __init__(self):
+        self.add_hook("frame", self.handle_frame)
+        self.add_hook("unload", self.handle_unload)
+        self.add_command("perf", self.cmd_perf, 5, usage="[on|off|reset|<name>]")
+        
+        # Set to 1 to start measuring when the plugin is loaded
+        self.set_cvar_once("qlx_perfEnabled", "0")
+        # Seconds between dumps to qlx_perfDumpPath, 0 to not dump at all
+        self.set_cvar_once("qlx_perfDumpInterval", "0")
+        self.set_cvar_once("qlx_perfDumpPath", "perf.jsonl")
+        
+        self._stop = threading.Event()
+        self.max_threads = threads()
+        self.reset_frames()
+        self.enable(bool(self.get_cvar("qlx_perfEnabled", int)))
+        if self.get_cvar("qlx_perfDumpInterval", float) > 0:
+            self.dumper()
+    
+    def enable(self, on):
+        global enabled
+        if on and not enabled:
+            self.reset_frames()
+        enabled = on
+        for plugin in list(_tracked):
+            if on:
+                _wrap(plugin)
+            else:
+                _unwrap(plugin)
+    
+    def reset_frames(self):
+        '''Starts counting frames and roster requests from zero.'''
+        self.frames = 0
+        self.roster_base = dict(roster.stats)
+    
+    def roster_per_frame(self):
+        '''Roster requests and builds (engine calls) per measured frame.'''
+        if not self.frames:
+            return {name: 0.0 for name in roster.stats}
+        return {name: (roster.stats[name] - self.roster_base.get(name, 0)) / self.frames for name in roster.stats}
+    
+    def summary(self):
+        self.max_threads = max(self.max_threads, threads())
+        return {"time": time.time(), "threads": threads(), "max_threads": self.max_threads,
+                "frames": self.frames, "roster": self.roster_per_frame(), "counters": counters(),
+                "handlers": {label: h.as_dict() for label, h in stats.items()}}
+    
+    @minqlx.thread
+    def dumper(self):
+        interval = self.get_cvar("qlx_perfDumpInterval", float)
+        path = self.get_cvar("qlx_perfDumpPath")
+        while not self._stop.wait(interval):
+            if not enabled:
+                continue
+            try:
+                with open(path, "a") as f:
+                    f.write(json.dumps(self.summary()) + "\n")
+            except OSError:
+                self.logger.exception("Could not write {}".format(path))
+    
+    def handle_frame(self):
+        if enabled:
+            self.frames += 1
+    
+    def handle_unload(self, plugin):
+        if plugin == self.__class__.__name__:
+            self._stop.set()
+            self.enable(False)
+    
+    def cmd_perf(self, player, msg, channel):
+        arg = msg[1].lower() if len(msg) > 1 else None
+        if arg in ("on", "off"):
+            self.enable(arg == "on")
+            outbox.reply(channel, "^7Performance counters are now {}.".format(arg))
+            return
+        if arg == "reset":
+            stats.clear()
+            self.reset_frames()
+            outbox.reply(channel, "^7Performance counters reset.")
+            return
+        
+        summary = self.summary()
+        if arg:
+            matches = [label for label in stats if arg in label.lower()]
+            if not matches:
+                outbox.reply(channel, "^7No handler matching {}.".format(arg))
+                return
+            label = min(matches, key=len)
+            h = stats[label]
+            bounds = ["<={}".format(b) for b in BUCKETS] + [">{}".format(BUCKETS[-1])]
+            outbox.reply(channel, "^7{}: {} calls, {:.1f} REDIS/call, max {:.0f}us".format(
+                label, h.calls, h.redis / h.calls, h.max * 1e6))
+            outbox.reply(channel, "^7" + " ".join("{}:{}".format(b, c) for b, c in zip(bounds, h.counts) if c))
+            return
+        
+        outbox.reply(channel, "^7Counters {}, {} threads (max {}).".format(
+            "on" if enabled else "off", summary["threads"], summary["max_threads"]))
+        outbox.reply(channel, "^7Roster per frame: {:.2f} requests, {:.2f} builds (engine calls) over {} frames.".format(
+            summary["roster"]["requests"], summary["roster"]["builds"], summary["frames"]))
+        for name, values in sorted(summary["counters"].items()):
+            outbox.reply(channel, "^7{}: {}".format(name, format_counters(values)))
+        for label, h in sorted(stats.items(), key=lambda item: -item[1].total)[:5]:
+            outbox.reply(channel, "^7{}: {} calls, {:.1f}ms total, p50 {:.0f}us p99 {:.0f}us, {:.1f} REDIS/call".format(
+                label, h.calls, h.total * 1000, h.percentile(0.5), h.percentile(0.99), h.redis / h.calls))
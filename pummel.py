@@ -16,44 +16,501 @@
 # that are on the server on the same time, Otherwise we could just spit out
 # steamIDs.
 
+# Gauntlet kills are counted in memory and written to REDIS in batched
+# pipelines by a background thread every qlx_pummelFlushInterval seconds,
+# when a game ends and when the plugin gets unloaded.
+
+# With qlx_pummelSchema set to 1 the counters of a killer are stored in a single
+# REDIS hash (victim -> count) instead of one key per killer/victim pair, which
+# REDIS keeps as a compact listpack for up to hash-max-listpack-entries victims.
+# !pummelmigrate converts existing counters and reports the memory saved. The
+# layout is also stored in REDIS, so after a migration every server sharing it
+# uses the hashes, whatever their qlx_pummelSchema says.
+
+# Server-wide leaderboards (!pummeltop, !pummelrivals) are kept in sorted sets
+# that are updated together with the counters, so they never need to look at
+# the counters themselves. !pummelrebuild recreates them from existing data.
+
+# Servers sharing one REDIS can set qlx_pummelShared to 1. They then tell each
+# other which counters they wrote and treat their copies of these, as well as
+# copies older than qlx_pummelCacheMaxAge seconds, as stale. Stale counters are
+# still shown while the flusher thread fetches them again. Counters that are
+# not cached at all (usually prefetched when players connect) are still read
+# right away. !pummelcache shows how many lookups the cache answered.
+
 import minqlx
+import threading
+
+from . import outbox
+from . import perf
+from . import roster
+from . import shared
 
 # DB related
 PLAYER_KEY = "minqlx:players:{}"
+PUMMELS_KEY = PLAYER_KEY + ":pummels"
+# Sorted sets: steam_id -> pummels dealt / received, "id:id" -> pummels between
+TOP_KILLERS_KEY = "minqlx:pummel:killers"
+TOP_VICTIMS_KEY = "minqlx:pummel:victims"
+TOP_RIVALS_KEY = "minqlx:pummel:rivals"
+# "1" once the counters are stored in hashes
+SCHEMA_KEY = "minqlx:pummel:schema"
 
 class pummel(minqlx.Plugin):
     def __init__(self):
         self.add_hook("kill", self.handle_kill)
+        self.add_hook("player_connect", self.handle_player_connect)
+        self.add_hook("player_disconnect", self.handle_player_disconnect)
+        self.add_hook("game_end", self.handle_game_end)
+        self.add_hook("unload", self.handle_unload)
+        roster.hook(self)
+        perf.track(self)
         
         self.add_command("pummel", self.cmd_pummel)
+        self.add_command("pummeltop", self.cmd_pummeltop)
+        self.add_command("pummelrivals", self.cmd_pummelrivals)
+        self.add_command("pummelmigrate", self.cmd_pummelmigrate, 5)
+        self.add_command("pummelrebuild", self.cmd_pummelrebuild, 5)
+        self.add_command("pummelcache", self.cmd_pummelcache, 5)
+        
+        # Seconds between two flushes of the pummel counters to REDIS
+        self.set_cvar_once("qlx_pummelFlushInterval", "10")
+        # Maximum amount of killer/victim pairs written per pipeline
+        self.set_cvar_once("qlx_pummelFlushBatch", "200")
+        # Storage layout: one key per pair (0) or one hash per killer (1)
+        self.set_cvar_once("qlx_pummelSchema", "0")
+        # Set to 1 if several servers use the same REDIS
+        self.set_cvar_once("qlx_pummelShared", "0")
+        # Seconds after which shared counters are fetched again
+        self.set_cvar_once("qlx_pummelCacheMaxAge", "60")
+        
+        # { (killer_id, victim_id) : count } including increments not yet
+        # written to REDIS, so the scoreline can be shown without a lookup.
+        self._counts = shared.cache(max_age=self.get_cvar("qlx_pummelCacheMaxAge", float) if self.shared() else None)
+        # { (killer_id, victim_id) : increment } waiting for the next flush
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # { steam_id : pairs in _counts they are part of }, so a player's
+        # counters can be dropped without looking at everybody else's
+        self._pairs_of = {}
+        # Stale pairs waiting to be fetched again by the flusher
+        self._refreshing = set()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._migrating = False
+        self._rebuilding = False
+        self._hashed = self.get_cvar("qlx_pummelSchema", int) == 1
+        if self._hashed:
+            self.db.set(SCHEMA_KEY, "1")
+        else:
+            self._hashed = self.db.get(SCHEMA_KEY) == "1"
+        
+        ids = [p.steam_id for p in roster.get().players]
+        self.warmup(ids, ids)
+        self.flusher()
+        if self.shared():
+            shared.listen(self.db, self.handle_invalidation, self._stop)
+    
+    ## Counter Cache
+    def pair_key(self, killer_id, victim_id):
+        return PLAYER_KEY.format(killer_id) + ":pummeled:" + str(victim_id)
+    
+    def hashed(self):
+        return self._hashed
+    
+    def switch_schema(self, schema):
+        '''Follows the layout another server stored in SCHEMA_KEY.'''
+        if schema == "1" and not self._hashed:
+            self._hashed = True
+            self.logger.info("Pummel counters were migrated to hashes, using them from now on.")
+        return self._hashed
+    
+    def shared(self):
+        return self.get_cvar("qlx_pummelShared", int) == 1
+    
+    def fetch_counts(self, pairs):
+        '''Reads the stored counters for (killer_id, victim_id) pairs in one round-trip.'''
+        if not self.hashed():
+            # Checked in the same round-trip, in case another server migrated.
+            pipe = self.db.pipeline(transaction=False)
+            pipe.get(SCHEMA_KEY)
+            pipe.mget([self.pair_key(*pair) for pair in pairs])
+            schema, counts = pipe.execute()
+            if not self.switch_schema(schema):
+                return counts
+        
+        victims = {}
+        for killer_id, victim_id in pairs:
+            victims.setdefault(killer_id, []).append(str(victim_id))
+        # While !pummelmigrate runs, counters not moved yet are still in their
+        # own keys. The migration moves them in transactions, so reading both
+        # in one transaction as well counts every kill exactly once.
+        migrating = self._migrating
+        pipe = self.db.pipeline(transaction=migrating)
+        for killer_id, ids in victims.items():
+            pipe.hmget(PUMMELS_KEY.format(killer_id), ids)
+        if migrating:
+            pipe.mget([self.pair_key(*pair) for pair in pairs])
+        results = pipe.execute()
+        values = {}
+        for (killer_id, ids), counts in zip(victims.items(), results):
+            for victim_id, count in zip(ids, counts):
+                values[(killer_id, victim_id)] = count
+        counts = [values[(killer_id, str(victim_id))] for killer_id, victim_id in pairs]
+        if migrating:
+            counts = [int(count or 0) + int(old or 0) for count, old in zip(counts, results[-1])]
+        return counts
+    
+    def load_counts(self, pairs, count=True):
+        '''Fetches uncached counters for (killer_id, victim_id) pairs. Stale
+        ones are used as they are and refreshed by the flusher thread. Only
+        lookups are counted in the cache statistics, prefetches pass count=False.
+        '''
+        with self._lock:
+            pairs, stale = self._counts.missing(pairs, count)
+            stale = [pair for pair in stale if pair not in self._refreshing]
+            self._refreshing.update(stale)
+        if stale:
+            self._wake.set()
+        if pairs:
+            self.store_counts(pairs, self.fetch_counts(pairs))
+    
+    def refresh(self):
+        '''Fetches the stale counters load_counts() came across again.'''
+        with self._lock:
+            pairs = list(self._refreshing)
+        if not pairs:
+            return
+        try:
+            self.store_counts(pairs, self.fetch_counts(pairs), replace=True)
+        except Exception:
+            self.logger.exception("Refreshing pummel counters failed.")
+        finally:
+            with self._lock:
+                self._refreshing.difference_update(pairs)
+    
+    def store_counts(self, pairs, values, replace=False):
+        '''Caches fetched counters plus the increments not written yet.'''
+        with self._lock:
+            for pair, value in zip(pairs, values):
+                if replace or pair not in self._counts:
+                    self._counts.put(pair, int(value or 0) + self._pending.get(pair, 0))
+                    self.index_pair(pair)
+    
+    def index_pair(self, pair):
+        '''Remembers a cached pair for both players. Call with _lock held.'''
+        for sid in pair:
+            pairs = self._pairs_of.get(sid)
+            if pairs is None:
+                pairs = self._pairs_of[sid] = set()
+            pairs.add(pair)
+    
+    @minqlx.thread
+    def warmup(self, steam_ids, others):
+        '''Loads the counters between steam_ids and others in the background.'''
+        pairs = {(sid, oid) for sid in steam_ids for oid in others if sid != oid}
+        pairs.update([(oid, sid) for sid, oid in pairs])
+        self.load_counts(list(pairs), count=False)
+    
+    ## Write-behind Handling
+    @minqlx.thread
+    def flusher(self):
+        '''Periodically writes pending increments to REDIS.'''
+        while not self._stop.is_set():
+            self._wake.wait(self.get_cvar("qlx_pummelFlushInterval", float))
+            self._wake.clear()
+            self.refresh()
+            self.flush()
+        # Whatever handle_unload couldn't write because of a running rebuild.
+        self.flush()
+    
+    def flush(self, blocking=True):
+        '''Writes all pending increments to REDIS using batched pipelines.
+        Without blocking it does nothing while another flush or a rebuild
+        holds the lock.
+        '''
+        if not self._flush_lock.acquire(blocking):
+            return
+        try:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            
+            items = list(pending.items())
+            batch = max(1, self.get_cvar("qlx_pummelFlushBatch", int))
+            hashed = self.hashed()
+            if items and not hashed:
+                hashed = self.switch_schema(self.db.get(SCHEMA_KEY))
+            for i in range(0, len(items), batch):
+                pipe = self.db.pipeline(transaction=False)
+                for (killer_id, victim_id), count in items[i:i + batch]:
+                    if hashed:
+                        pipe.hincrby(PUMMELS_KEY.format(killer_id), str(victim_id), count)
+                    else:
+                        pipe.sadd(PLAYER_KEY.format(killer_id) + ":pummeled", str(victim_id))
+                        pipe.incrby(self.pair_key(killer_id, victim_id), count)
+                    self.index(pipe, killer_id, victim_id, count)
+                if self.shared():
+                    shared.publish(pipe, [self.pair_key(*pair) for pair, count in items[i:i + batch]])
+                try:
+                    pipe.execute()
+                except Exception:
+                    # Keep whatever was not written for the next attempt.
+                    with self._lock:
+                        for pair, count in items[i:]:
+                            self._pending[pair] = self._pending.get(pair, 0) + count
+                    self.logger.exception("Flushing pummel counters failed.")
+                    return
+        finally:
+            self._flush_lock.release()
+    
+    def handle_invalidation(self, key):
+        '''Marks the counter another server wrote to key as stale.'''
+        parts = key.split(":")
+        if len(parts) == 5 and parts[3] == "pummeled":
+            with self._lock:
+                self._counts.invalidate((int(parts[2]), int(parts[4])))
+    
+    ## Leaderboards
+    def index(self, pipe, killer_id, victim_id, count, suffix=""):
+        '''Adds count pummels of killer_id on victim_id to the leaderboards.'''
+        rivals = "{}:{}".format(*sorted((int(killer_id), int(victim_id))))
+        pipe.zincrby(TOP_KILLERS_KEY + suffix, count, str(killer_id))
+        pipe.zincrby(TOP_VICTIMS_KEY + suffix, count, str(victim_id))
+        pipe.zincrby(TOP_RIVALS_KEY + suffix, count, rivals)
+    
+    def names(self, steam_ids):
+        '''Looks up the last known names of steam_ids in one round-trip.'''
+        pipe = self.db.pipeline(transaction=False)
+        for sid in steam_ids:
+            pipe.lindex(PLAYER_KEY.format(sid), 0)
+        return [name or str(sid) for sid, name in zip(steam_ids, pipe.execute())]
+    
+    @minqlx.thread
+    def show_top(self, channel, count):
+        pipe = self.db.pipeline(transaction=False)
+        pipe.zrevrange(TOP_KILLERS_KEY, 0, count - 1, withscores=True)
+        pipe.zrevrange(TOP_VICTIMS_KEY, 0, count - 1, withscores=True)
+        killers, victims = pipe.execute()
+        names = self.names([sid for sid, _ in killers + victims])
+        
+        killers_msg = "^1Top Pummelers^7 >> "
+        for name, (sid, score) in zip(names, killers):
+            killers_msg += "{}^7: ^1{}^7 ".format(name, int(score))
+        victims_msg = "^1Most Pummeled^7 >> "
+        for name, (sid, score) in zip(names[len(killers):], victims):
+            victims_msg += "{}^7: ^1{}^7 ".format(name, int(score))
+        outbox.reply(channel, killers_msg)
+        outbox.reply(channel, victims_msg)
+    
+    @minqlx.thread
+    def show_rivals(self, channel, count):
+        rivals = self.db.zrevrange(TOP_RIVALS_KEY, 0, count - 1)
+        pairs = [tuple(int(sid) for sid in r.split(":")) for r in rivals]
+        # Both directions of every rivalry and both names, one round-trip each.
+        scores = self.fetch_counts([pair for a, b in pairs for pair in ((a, b), (b, a))])
+        names = self.names([sid for pair in pairs for sid in pair])
         
+        msg = "^1Rivals^7 >> "
+        for i in range(len(pairs)):
+            msg += "{}^7 ^1{}^7:^1{}^7 {}^7  ".format(names[2*i], int(scores[2*i] or 0),
+                int(scores[2*i + 1] or 0), names[2*i + 1])
+        outbox.reply(channel, msg)
+    
+    @minqlx.thread
+    def rebuild(self, channel):
+        '''Recreates the leaderboards from the counters of both schemas.'''
+        batch = max(1, self.get_cvar("qlx_pummelFlushBatch", int))
+        pairs = 0
+        # No flushes meanwhile, otherwise their kills would get lost on RENAME.
+        with self._flush_lock:
+            try:
+                pipe = self.db.pipeline(transaction=False)
+                pipe.delete(TOP_KILLERS_KEY + ":rebuild", TOP_VICTIMS_KEY + ":rebuild", TOP_RIVALS_KEY + ":rebuild")
+                pipe.execute()
+                
+                for set_key in self.db.scan_iter(match=PLAYER_KEY.format("*") + ":pummeled", count=batch):
+                    killer_id = set_key.split(":")[2]
+                    victims = list(self.db.smembers(set_key))
+                    for i in range(0, len(victims), batch):
+                        chunk = victims[i:i + batch]
+                        counts = self.db.mget([set_key + ":" + victim_id for victim_id in chunk])
+                        pipe = self.db.pipeline(transaction=False)
+                        for victim_id, count in zip(chunk, counts):
+                            if count:
+                                self.index(pipe, killer_id, victim_id, int(count), ":rebuild")
+                                pairs += 1
+                        pipe.execute()
+                
+                for hash_key in self.db.scan_iter(match=PUMMELS_KEY.format("*"), count=batch):
+                    killer_id = hash_key.split(":")[2]
+                    pipe = self.db.pipeline(transaction=False)
+                    for victim_id, count in self.db.hgetall(hash_key).items():
+                        self.index(pipe, killer_id, victim_id, int(count), ":rebuild")
+                        pairs += 1
+                    pipe.execute()
+                
+                pipe = self.db.pipeline()
+                for key in (TOP_KILLERS_KEY, TOP_VICTIMS_KEY, TOP_RIVALS_KEY):
+                    if pairs:
+                        pipe.rename(key + ":rebuild", key)
+                    else:
+                        pipe.delete(key)
+                pipe.execute()
+            finally:
+                self._rebuilding = False
+        
+        outbox.reply(channel, "^7Rebuilt pummel leaderboards from ^1{}^7 counters.".format(pairs))
+    
+    ## Schema Migration
+    @minqlx.thread
+    def migrate(self, channel):
+        '''Moves all per-pair counters into per-killer hashes, SCAN batch by batch.'''
+        before = self.db.info("memory")["used_memory"]
+        batch = max(1, self.get_cvar("qlx_pummelFlushBatch", int))
+        killers = pairs = 0
+        # Tells the other servers and future sessions to use the hashes too.
+        self.db.set(SCHEMA_KEY, "1")
+        # A flush that started before the schema switched may still be writing
+        # per-pair keys; wait for it so the SCAN sees its kills.
+        with self._flush_lock:
+            pass
+        try:
+            for set_key in self.db.scan_iter(match=PLAYER_KEY.format("*") + ":pummeled", count=batch):
+                hash_key = set_key[:-len(":pummeled")] + ":pummels"
+                victims = list(self.db.smembers(set_key))
+                for i in range(0, len(victims), batch):
+                    chunk = victims[i:i + batch]
+                    keys = [set_key + ":" + victim_id for victim_id in chunk]
+                    counts = self.db.mget(keys)
+                    # HINCRBY rather than HSET: kills flushed since the schema
+                    # switched are already in the hash and must be kept.
+                    pipe = self.db.pipeline()
+                    for victim_id, count in zip(chunk, counts):
+                        if count:
+                            pipe.hincrby(hash_key, victim_id, int(count))
+                    pipe.srem(set_key, *chunk)
+                    pipe.delete(*keys)
+                    pipe.execute()
+                    pairs += len(chunk)
+                killers += 1
+        finally:
+            self._migrating = False
+            # Anything cached meanwhile is read again from the hashes.
+            with self._lock:
+                for pair in self._counts:
+                    if pair not in self._pending:
+                        del self._counts[pair]
+        
+        after = self.db.info("memory")["used_memory"]
+        outbox.reply(channel, "^7Migrated ^1{}^7 pummel counters of ^1{}^7 players. REDIS memory: {:.2f} MiB -> {:.2f} MiB."
+            .format(pairs, killers, before / 2**20, after / 2**20))
+    
+    ## Plugin Handles and Commands
+    @perf.timed
+    def handle_player_connect(self, player):
+        self.warmup([player.steam_id], [p.steam_id for p in roster.get().players])
+    
+    @perf.timed
+    def handle_player_disconnect(self, player, reason):
+        sid = player.steam_id
+        with self._lock:
+            kept = set()
+            for pair in self._pairs_of.pop(sid, ()):
+                if pair in self._pending:
+                    kept.add(pair)
+                    continue
+                if pair in self._counts:
+                    del self._counts[pair]
+                other = self._pairs_of.get(pair[1] if pair[0] == sid else pair[0])
+                if other is not None:
+                    other.discard(pair)
+            if kept:
+                self._pairs_of[sid] = kept
+    
+    @perf.timed
+    def handle_game_end(self, data):
+        self._wake.set()
+    
+    @perf.timed
+    def handle_unload(self, plugin):
+        if plugin == self.__class__.__name__:
+            self._stop.set()
+            self._wake.set()
+            # Don't wait for a rebuild on the game thread, the flusher
+            # writes the rest once it is done.
+            self.flush(blocking=False)
+    
+    @perf.timed
     def handle_kill(self, victim, killer, data):
         if data["MOD"] == "GAUNTLET" and self.game.state == "in_progress":
-            self.play_sound("sound/vo_evil/humiliation1")
+            outbox.play_sound("sound/vo_evil/humiliation1")
             
-            self.db.sadd(PLAYER_KEY.format(killer.steam_id) + ":pummeled", str(victim.steam_id))
-            self.db.incr(PLAYER_KEY.format(killer.steam_id) + ":pummeled:" + str(victim.steam_id))
-    
-            killer_score = self.db[PLAYER_KEY.format(killer.steam_id) + ":pummeled:" + str(victim.steam_id)]
-            victim_score = 0
-            if PLAYER_KEY.format(victim.steam_id) + ":pummeled:" + str(killer.steam_id) in self.db:
-                victim_score = self.db[PLAYER_KEY.format(victim.steam_id) + ":pummeled:" + str(killer.steam_id)]
+            k, v = killer.steam_id, victim.steam_id
+            self.load_counts([(k, v), (v, k)])
+            with self._lock:
+                killer_score = self._counts[(k, v)] = self._counts.peek((k, v), 0) + 1
+                self.index_pair((k, v))
+                self._pending[(k, v)] = self._pending.get((k, v), 0) + 1
+                victim_score = self._counts.peek((v, k), 0)
             
             msg = "^1PUMMEL!^7 {} ^1{}^7:^1{}^7 {}".format(killer.name, killer_score, victim_score, victim.name)
-            self.msg(msg)
+            outbox.msg(msg)
     
+    @perf.timed
     def cmd_pummel(self, player, msg, channel):
-        pummels = self.db.smembers(PLAYER_KEY.format(player.steam_id) + ":pummeled")
-        players = self.teams()["spectator"] + self.teams()["red"] + self.teams()["blue"] + self.teams()["free"]
+        # Only victims that are on the server can be shown, so instead of
+        # walking the whole :pummeled set we just fetch the counters against
+        # everybody connected in one go. A count of 0 means "never pummeled".
+        sid = player.steam_id
+        players = [p for p in roster.get().players if p.steam_id != sid]
+        self.load_counts([(sid, p.steam_id) for p in players])
         
         msg = ""
-        for p in pummels:
+        with self._lock:
             for pl in players:
-                if p == str(pl.steam_id):
-                    count = self.db[PLAYER_KEY.format(player.steam_id) + ":pummeled:" + p]
-                    msg +=  pl.name + ": ^1" + count + "^7 "
+                count = self._counts.peek((sid, pl.steam_id), 0)
+                if count:
+                    msg += pl.name + ": ^1" + str(count) + "^7 "
         if msg == "":
-            self.msg("{} has not pummeled anybody on this server.".format(player))
+            outbox.msg("{} has not pummeled anybody on this server.".format(player))
         else:
-            self.msg("Pummel Stats for {}:".format(player))
-            self.msg(msg)
+            outbox.msg("Pummel Stats for {}:".format(player))
+            outbox.msg(msg)
+    
+    @perf.timed
+    def cmd_pummelmigrate(self, player, msg, channel):
+        if self._migrating:
+            outbox.reply(channel, "^7Pummel counters are being migrated already.")
+            return minqlx.RET_STOP_ALL
+        
+        # New kills go to the hashes right away, the migration merges the rest.
+        self._migrating = True
+        self._hashed = True
+        self.set_cvar("qlx_pummelSchema", "1")
+        outbox.reply(channel, "^7Migrating pummel counters to hashes...")
+        self.migrate(channel)
+    
+    @perf.timed
+    def cmd_pummeltop(self, player, msg, channel):
+        self.show_top(channel, 5)
+    
+    @perf.timed
+    def cmd_pummelrivals(self, player, msg, channel):
+        self.show_rivals(channel, 5)
+    
+    @perf.timed
+    def cmd_pummelrebuild(self, player, msg, channel):
+        if self._rebuilding:
+            outbox.reply(channel, "^7Pummel leaderboards are being rebuilt already.")
+            return minqlx.RET_STOP_ALL
+        
+        self._rebuilding = True
+        outbox.reply(channel, "^7Rebuilding pummel leaderboards...")
+        self.rebuild(channel)
+    
+    @perf.timed
+    def cmd_pummelcache(self, player, msg, channel):
+        stats = self._counts.stats
+        outbox.reply(channel, "^7Pummel cache: ^1{}^7 counters, ^1{:.0%}^7 hits ({} hits, {} misses, {} stale, {} invalidated).".format(
+            len(self._counts), self._counts.ratio(), stats["hits"], stats["misses"], stats["stale"], stats["invalidated"]))
@@ -21,11 +21,54 @@
 # The plugin also features an AFK list, to which players can 
 # subscribe/unsubscribe to.
 
+# Both lists are saved to REDIS on map change and plugin unload and restored
+# when the plugin is loaded again, so waiting times survive reloads.
+
+# Clan tags are cached to restore them after the AFK tag. Servers sharing one
+# REDIS can set qlx_queueSharedTags to 1 to fetch a tag again whenever REDIS
+# reports it changed (needs keyspace notifications, see shared.py).
+
 import minqlx
+import collections
 import datetime
+import heapq
+import itertools
+import json
+import threading
 import time
 
+from . import outbox
+from . import perf
+from . import roster
+from . import shared
+
 _tag_key = "minqlx:players:{}:clantag"
+# One per server (net_port), several servers may share the database
+_snapshot_key = "minqlx:queue:{}:snapshot"
+
+# Clan tags kept in memory. Tags of departed players are evicted first.
+_tags_max = 128
+
+# Game types auto-fill puts players into red and blue in
+_team_games = ("ca", "tdm", "ctf", "ft", "ad", "dom", "1f", "har")
+
+# Upper bounds (microseconds) of the handle_configstring timing histogram
+_cs_buckets = (1, 2, 5, 10, 20, 50, 100, 1000)
+
+class entry():
+    '''A player waiting in the queue or in the AFK list.'''
+    __slots__ = ("player", "name", "joinTime", "seq", "remPending", "remPendingDeadline")
+    _seq = itertools.count()
+    
+    def __init__(self, player, joinTime=None):
+        self.player = player
+        self.name = player.name
+        self.joinTime = joinTime or datetime.datetime.now()
+        # Breaks ties between equal join times, entries are ordered by seq.
+        self.seq = next(entry._seq)
+        self.remPending = False
+        # time.monotonic() at which the entry expires while remPending
+        self.remPendingDeadline = None
 
 class queue(minqlx.Plugin):
     def __init__(self):
@@ -33,126 +76,240 @@ class queue(minqlx.Plugin):
         self.add_hook("player_disconnect", self.handle_player_disconnect)
         self.add_hook("team_switch", self.handle_team_switch)
         self.add_hook("set_configstring", self.handle_configstring)
+        self.add_hook("frame", self.handle_frame)
+        self.add_hook("map", self.handle_map)
+        self.add_hook("unload", self.handle_unload)
+        roster.hook(self)
+        perf.track(self)
         self.add_command(("q", "queue"), self.cmd_lq)
         self.add_command("afk", self.cmd_afk)
         self.add_command("here", self.cmd_playing)
+        self.add_command("autofill", self.cmd_autofill, 5, usage="[on|off]")
         
-        self._queue = []
-        self._afk   = []
-        self.initialize()
+        # { steam_id : entry } in join order
+        self._queue = collections.OrderedDict()
+        self._afk   = collections.OrderedDict()
+        # Name and status parts of the !q output, rebuilt only after changes
+        self._segments = None
+        self.renderRebuilds = 0
+        # (deadline, seq, steam_id) of pending removals. Cleared or renewed
+        # entries are left in here and skipped when their deadline comes.
+        self._expiry = []
+        # AFK flag per client slot, so handle_configstring can skip everybody
+        # else without looking the player up.
+        self._afkSlots = [False] * 64
+        self.csCalls = 0
+        self.csFast = 0
+        self.csHistogram = [0] * (len(_cs_buckets) + 1)
+        # { steam_id : clan tag } in LRU order, so the AFK tag can be removed
+        # again without asking the database
+        self._tags = shared.cache(max_size=_tags_max)
+        # Clan tag last seen in each slot's configstring
+        self._slotTags = [None] * 64
+        # time.monotonic() at which each open team slot became free
+        self._openSlots = {"red": collections.deque(), "blue": collections.deque()}
+        self._fillPending = False
+        # Players who just left a team, auto-fill doesn't put them back
+        self._fillSkip = set()
+        self.slotsFilled = 0
+        self.slotsAutoFilled = 0
+        self.slotIdleTotal = 0.0
+        self.slotIdleMax = 0.0
         
         # Minimum time to play before a player gets removed from the queue (3m)
         self.set_cvar_once("qlx_queueRemPendingTime", "180")
         self.set_cvar_once("qlx_queueSetAfkPermission", "2")
         self.set_cvar_once("qlx_queueAFKTag", "^3AFK")
+        # Seconds a saved queue stays valid for restoring it on plugin load
+        self.set_cvar_once("qlx_queueSnapshotTTL", "600")
+        # Set to 1 to move the first player in the queue into a team as soon
+        # as a slot opens
+        self.set_cvar_once("qlx_queueAutoFill", "0")
+        # Set to 1 if several servers use the same REDIS
+        self.set_cvar_once("qlx_queueSharedTags", "0")
+        
+        self.snapshotKey = _snapshot_key.format(self.get_cvar("net_port"))
+        self._stop = threading.Event()
+        if self.get_cvar("qlx_queueSharedTags", int):
+            shared.listen(self.db, self.handle_tag_changed, self._stop, (_tag_key.format("*"),))
+        
+        self.initialize()
     
     def initialize(self):
-        '''Puts spectators into queue when the plugin is loaded.'''
-        specs = self.teams()["spectator"]
-        for spec in specs:
-            self.add(spec)
-            time.sleep(0.01)
+        '''Puts spectators into queue when the plugin is loaded. Players that
+        are in the saved snapshot keep their join time and state, the others
+        share one join time and are queued in slot order behind them.
+        '''
+        snap = roster.get()
+        self.restore()
+        self.loadTags([p.steam_id for p in snap.players])
+        
+        now = datetime.datetime.now()
+        for spec in snap.teams["spectator"]:
+            if spec.steam_id not in self._queue and spec.steam_id not in self._afk:
+                self._queue[spec.steam_id] = entry(spec, now)
+        self._segments = None
+    
+    ## Snapshots
+    def snapshot(self):
+        '''Returns the queue and AFK list as a JSON string.'''
+        now, wall = time.monotonic(), time.time()
+        return json.dumps({
+            "queue": [[sid, item.joinTime.timestamp(),
+                       item.remPendingDeadline - now + wall if item.remPending else None]
+                      for sid, item in self._queue.items()],
+            "afk": [[sid, item.joinTime.timestamp()] for sid, item in self._afk.items()]})
+    
+    @minqlx.thread
+    def saveSnapshot(self, data):
+        self.writeSnapshot(data)
+    
+    def writeSnapshot(self, data):
+        '''Writes the snapshot as a single key, replacing the previous one.'''
+        self.db.set(self.snapshotKey, data, ex=self.get_cvar("qlx_queueSnapshotTTL", int))
+    
+    def restore(self):
+        '''Rebuilds the lists from the saved snapshot, keeping only players
+        that are still on the server. Entries stay in their saved join order.
+        '''
+        data = self.db.get(self.snapshotKey)
+        if not data:
+            return
+        data = json.loads(data)
+        
+        players = roster.get().by_steam_id
+        restored = []
+        for sid, joinTime, deadline in data["queue"]:
+            if sid in players:
+                restored.append((joinTime, players[sid], deadline, False))
+        for sid, joinTime in data["afk"]:
+            if sid in players and players[sid].team == "spectator":
+                restored.append((joinTime, players[sid], None, True))
+        
+        # One pass in join order, so the sequence numbers follow it as well.
+        now, wall = time.monotonic(), time.time()
+        for joinTime, player, deadline, afk in sorted(restored, key=lambda r: r[0]):
+            item = entry(player, datetime.datetime.fromtimestamp(joinTime))
+            if afk:
+                self._afk[player.steam_id] = item
+                self._afkSlots[player.id] = True
+                continue
+            
+            self._queue[player.steam_id] = item
+            if player.team != "spectator":
+                # Players who joined a team while we were gone count from now.
+                if deadline is None:
+                    deadline = wall + self.get_cvar("qlx_queueRemPendingTime", int)
+                item.remPending = True
+                item.remPendingDeadline = deadline - wall + now
+                heapq.heappush(self._expiry, (item.remPendingDeadline, item.seq, player.steam_id))
+        self._segments = None
     
     ## Basic List Handling (Queue and AFK)
-    def add(self, player, pos=-1):
+    def add(self, player):
         '''Safely adds players to the queue'''
-        slot = {"name": player.name, "player" : player, "joinTime" : datetime.datetime.now()}
-        if pos == -1:
-            self._queue.append(slot)
-        else:
-            self._queue.insert(pos, slot)
+        self._queue[player.steam_id] = entry(player)
+        self._segments = None
+    
+    def insort(self, lst, item):
+        '''Puts item back into lst at its join position. Only the entries that
+        joined after item have to be moved, usually none.
+        '''
+        later = []
+        for sid in reversed(lst):
+            if lst[sid].seq < item.seq:
+                break
+            later.append(sid)
+        
+        lst[item.player.steam_id] = item
+        for sid in reversed(later):
+            lst.move_to_end(sid)
+        self._segments = None
     
     def rem(self, player):
         '''Safely removes players from the queue'''
-        for item in self._queue:
-            if item["player"] == player:
-                self._queue.remove(item)
+        if self._queue.pop(player.steam_id, None):
+            self._segments = None
     
     def remAFK(self, player):
         '''Safely removes players from afk list'''
-        for item in self._afk:
-            if item["player"] == player:
-                self._afk.remove(item)
+        if self._afk.pop(player.steam_id, None):
+            self._afkSlots[player.id] = False
+            self._segments = None
     
     def inqueue(self, player):
         '''Returns True if player is in queue'''
-        for item in self._queue:
-            if item["player"] == player:
-                return True
-        return False
+        return player.steam_id in self._queue
     
     def inafk(self, player):
         '''Returns True if player is in AFK'''
-        for item in self._afk:
-            if item["player"] == player:
-                return True
-        return False
+        return player.steam_id in self._afk
     
     def clLists(self):
         '''Testing showed that sometimes players remain in the queue even 
         if they left the server long time ago. I built this to clean the lists.
         '''
-        players = self.teams()["spectator"] + self.teams()["red"] + self.teams()["blue"]
-        for pl in self._queue:
-            if pl["player"] not in players:
-                self.rem(pl["player"])
-                
-        for pl in self._afk:
-            if pl["player"] not in players:
-                self.remAFK(pl["player"])
+        players = roster.get().by_steam_id
+        for sid in [sid for sid in self._queue if sid not in players]:
+            del self._queue[sid]
+            self._segments = None
+        
+        for sid in [sid for sid in self._afk if sid not in players]:
+            self._afkSlots[self._afk.pop(sid).player.id] = False
+            self._segments = None
     
     ## Queue Removal Handling
     def setRemPending(self, player):
         '''Set pending removal'''
-        for item in self._queue:
-            if item["player"] == player:
-                item["RemPending"] = True
-                item["RemPendingTime"] = datetime.datetime.now()
+        item = self._queue.get(player.steam_id)
+        if item:
+            item.remPending = True
+            item.remPendingDeadline = time.monotonic() + self.get_cvar("qlx_queueRemPendingTime", int)
+            heapq.heappush(self._expiry, (item.remPendingDeadline, item.seq, player.steam_id))
+            self._segments = None
     
     def clRemPending(self, player):
         '''Clear pending removal'''
-        for item in self._queue:
-            if item["player"] == player:
-                if "RemPending" in item.keys():
-                    del item["RemPending"]
-                    del item["RemPendingTime"]
+        item = self._queue.get(player.steam_id)
+        if item and item.remPending:
+            item.remPending = False
+            item.remPendingDeadline = None
+            self._segments = None
     
     def isRemPending(self, player):
         '''Returns True if player is pending for removal from the queue'''
-        for item in self._queue:
-            if item["player"] == player:
-                if "RemPending" in item.keys():
-                    return True
-                else:
-                    return False
+        item = self._queue.get(player.steam_id)
+        return bool(item and item.remPending)
     
     def RemPending(self):
-        '''Removes players from the queue when they are flagged for removal'''
-        qcopy = self._queue.copy()
-        for item in qcopy:
-            if "RemPending" in item.keys():
-                delta = datetime.datetime.now() - item["RemPendingTime"]
-                if delta.seconds > self.get_cvar("qlx_queueRemPendingTime", int):
-                    self.rem(item["player"])
+        '''Removes players from the queue whose pending removal is due'''
+        now = time.monotonic()
+        while self._expiry and self._expiry[0][0] <= now:
+            deadline, seq, sid = heapq.heappop(self._expiry)
+            item = self._queue.get(sid)
+            if item and item.remPending and item.remPendingDeadline == deadline:
+                self.rem(item.player)
     
     ## AFK Handling
     def setAFK(self, player):
         '''Returns True if player's state could be set to AFK'''
         if self.isRemPending(player):
             return False
-        for i in range(len(self._queue)):
-            if self._queue[i]["player"] == player:
-                self._afk.append(self._queue.pop( i ))
-                return True
-        return False
+        item = self._queue.pop(player.steam_id, None)
+        if not item:
+            return False
+        self.insort(self._afk, item)
+        self._afkSlots[player.id] = True
+        return True
     
     def setPlaying(self, player):
         '''Returns True if player's state could be set to AVAILABLE'''
-        for i in range(len(self._afk)):
-            if self._afk[i]["player"] == player:
-                self._queue.append(self._afk.pop( i ))
-                return True
-        return False
+        item = self._afk.pop(player.steam_id, None)
+        if not item:
+            return False
+        self._afkSlots[player.id] = False
+        self.insort(self._queue, item)
+        return True
     
     @minqlx.next_frame
     def setAFKTag(self, player):
@@ -162,23 +319,149 @@ class queue(minqlx.Plugin):
     @minqlx.next_frame
     def clAFKTag(self, player):
         '''Sets player's clantag again if there was any'''
-        tag_key = _tag_key.format(player.steam_id)
-        tag = ""
-        if tag_key in self.db:
-            tag = self.db[tag_key]
+        player.clan = self._tags.get(player.steam_id, "")
+    
+    ## Clan Tags
+    @minqlx.thread
+    def loadTags(self, steam_ids, replace=False):
+        '''Fetches the stored clan tags of steam_ids in one round-trip.'''
+        pipe = self.db.pipeline()
+        for sid in steam_ids:
+            pipe.get(_tag_key.format(sid))
+        self.cacheTags(dict(zip(steam_ids, pipe.execute())), replace)
+    
+    @minqlx.next_frame
+    def cacheTags(self, tags, replace):
+        for sid, tag in tags.items():
+            # Unless the stored tag just changed, a tag seen in a configstring
+            # meanwhile is newer.
+            if replace or sid not in self._tags:
+                self.cacheTag(sid, tag or "")
+    
+    def cacheTag(self, steam_id, tag):
+        self._tags.put(steam_id, tag)
+    
+    def handle_tag_changed(self, key):
+        '''Called by the shared.listen() thread for changed clan tags.'''
+        parts = key.split(":")
+        if len(parts) == 4 and parts[3] == "clantag":
+            self.reloadTag(int(parts[2]))
+    
+    @minqlx.next_frame
+    def reloadTag(self, steam_id):
+        self._tags.invalidate(steam_id)
+        self.loadTags([steam_id], replace=True)
+    
+    def noteTag(self, slot, value):
+        '''Updates the cached tag from a player's configstring, unless it
+        is our own AFK tag.
+        '''
+        start = value.find("\\cn\\")
+        if start == -1:
+            tag = ""
+        else:
+            start += 4
+            end = value.find("\\", start)
+            tag = value[start:end] if end != -1 else value[start:]
+        
+        if tag == self._slotTags[slot] or tag == self.get_cvar("qlx_queueAFKTag"):
+            return
+        
+        player = roster.get().by_slot[slot]
+        if player:
+            self._slotTags[slot] = tag
+            self.cacheTag(player.steam_id, tag)
+    
+    ## Auto-Fill
+    def slotOpened(self, team, leaving=None):
+        '''Notes the time a slot of team became free, if the team is now
+        short of players. The leaving player (a steam_id) is not counted and
+        not put back by the auto-fill.
+        '''
+        game = self.game
+        if game is None or team not in self._openSlots or game.type_short not in _team_games:
+            return
+        if sum(1 for p in roster.get().teams[team] if p.steam_id != leaving) >= game.teamsize:
+            return
+        self._openSlots[team].append(time.monotonic())
+        if self.get_cvar("qlx_queueAutoFill", int):
+            self._fillSkip.add(leaving)
+            if not self._fillPending:
+                self._fillPending = True
+                self.autoFill()
+    
+    def slotFilled(self, team):
+        '''Records for how long the oldest open slot of team stayed empty.'''
+        slots = self._openSlots.get(team)
+        if not slots:
+            return
+        idle = time.monotonic() - slots.popleft()
+        self.slotsFilled += 1
+        self.slotIdleTotal += idle
+        self.slotIdleMax = max(self.slotIdleMax, idle)
+    
+    def nextInQueue(self, players, skip):
+        '''Returns the first spectator in the queue. AFK players are in
+        another list and only those who already joined a team can be pending,
+        so at most a couple of entries are skipped.
+        '''
+        for sid, item in self._queue.items():
+            if item.remPending or sid in skip:
+                continue
+            player = players.get(sid)
+            if player and player.team == "spectator":
+                return player
+        return None
+    
+    @minqlx.next_frame
+    def autoFill(self):
+        '''Puts queued players into the smaller team while it has room.'''
+        self._fillPending = False
+        skip, self._fillSkip = self._fillSkip, set()
+        game = self.game
+        if game is None or game.type_short not in _team_games:
+            return
         
-        player.clan = tag
+        snap = roster.get()
+        size = {"red": len(snap.teams["red"]), "blue": len(snap.teams["blue"])}
+        players = dict(snap.by_steam_id)
+        while True:
+            team = "red" if size["red"] <= size["blue"] else "blue"
+            if size[team] >= game.teamsize:
+                return
+            player = self.nextInQueue(players, skip)
+            if not player:
+                return
+            del players[player.steam_id]
+            size[team] += 1
+            self.slotsAutoFilled += 1
+            player.put(team)
+    
+    def perf_counters(self):
+        '''Configstring fast path and run times (in us), shown by !perf.'''
+        bounds = ["<={}".format(b) for b in _cs_buckets] + [">{}".format(_cs_buckets[-1])]
+        return {"configstrings": self.csCalls, "fast": self.csFast,
+                "us": collections.OrderedDict(zip(bounds, self.csHistogram))}
     
     ## Plugin Handles and Commands
+    @perf.timed
     def handle_player_connect(self, player):
         if not self.inqueue(player):
             self.add(player)
+        self.loadTags([player.steam_id])
     
+    @perf.timed
     def handle_player_disconnect(self, player, reason):
-        self.setPlaying(player)
+        self.remAFK(player)
         self.rem(player)
+        self.slotOpened(player.team, player.steam_id)
+        self._slotTags[player.id] = None
+        self._tags.demote(player.steam_id)
     
+    @perf.timed
     def handle_team_switch(self, player, old_team, new_team):
+        self.slotOpened(old_team, player.steam_id)
+        self.slotFilled(new_team)
         if new_team == "spectator":
             if not self.inqueue(player):
                 self.add(player)
@@ -189,83 +472,133 @@ class queue(minqlx.Plugin):
             self.clAFKTag(player)
             self.setRemPending(player)
     
+    @perf.timed
+    def handle_map(self, mapname, factory):
+        for slots in self._openSlots.values():
+            slots.clear()
+        self.saveSnapshot(self.snapshot())
+    
+    @perf.timed
+    def handle_unload(self, plugin):
+        if plugin == self.__class__.__name__:
+            self._stop.set()
+            # Not in a thread: on !reload the new instance reads it right away.
+            self.writeSnapshot(self.snapshot())
+    
+    @perf.timed
+    def handle_frame(self):
+        if self._expiry:
+            self.RemPending()
+    
+    @perf.timed
     def handle_configstring(self, index, value):
+        start = time.perf_counter()
+        ret = self.configstring(index, value)
+        micros = (time.perf_counter() - start) * 1000000
+        
+        self.csCalls += 1
+        for i, bound in enumerate(_cs_buckets):
+            if micros <= bound:
+                self.csHistogram[i] += 1
+                break
+        else:
+            self.csHistogram[-1] += 1
+        return ret
+    
+    def configstring(self, index, value):
         if not value:
+            self.csFast += 1
             return
         
         elif 529 <= index < 529 + 64:
-            try:
-                player = self.player(index - 529)
-            except minqlx.NonexistentPlayerError:
+            self.noteTag(index - 529, value)
+            if not self._afkSlots[index - 529]:
+                self.csFast += 1
+                return
+            
+            player = roster.get().by_slot[index - 529]
+            if not player:
                 return
             
             if self.inafk(player):
                 self.setAFKTag(player)
                 return minqlx.RET_STOP 
+        
+        else:
+            self.csFast += 1
+    
+    def segments(self):
+        '''Returns the (name, joinTime, status) parts of the queue and the
+        AFK list. They only change with the lists, so they are cached and the
+        waiting times are the only thing left to format on every !q.
+        '''
+        if self._segments is None:
+            self.renderRebuilds += 1
+            self._segments = (
+                [(item.name + ": ", item.joinTime, "^2*^7 " if item.remPending else " ") for item in self._queue.values()],
+                [(item.name + ": ", item.joinTime, " ") for item in self._afk.values()])
+        return self._segments
     
+    def waitingTime(self, now, joinTime):
+        diff = now - joinTime
+        seconds = diff.days * 3600 * 24
+        seconds = seconds + diff.seconds
+        minutes = seconds // 60
+        if minutes:
+            return "^1{}m^7".format(minutes)
+        else:
+            return "^1{}s^7".format(seconds)
+    
+    @perf.timed
     def cmd_lq(self, player, msg, channel):
         self.clLists()
-        self.RemPending()
         
-        namesbytime = sorted(self._queue, key= lambda item: item["joinTime"])
+        queued, away = self.segments()
+        now = datetime.datetime.now()
+        
         msg = "^7No one in queue."
-        if self._queue:
-            msg = "^1Queue^7 >> "
-            for item in namesbytime:
-                diff = datetime.datetime.now() - item["joinTime"]
-                seconds = diff.days * 3600 * 24
-                seconds = seconds + diff.seconds
-                minutes = seconds // 60
-                waiting_time = ""
-                if minutes:
-                    waiting_time = "^1{}m^7".format(minutes)
-                else:
-                    waiting_time = "^1{}s^7".format(seconds)
-                
-                if self.isRemPending(item["player"]):
-                    msg += item["name"] + ": " + waiting_time + "^2*^7 "
-                else:
-                    msg += item["name"] + ": " + waiting_time + " "
-        channel.reply(msg)
+        if queued:
+            msg = "^1Queue^7 >> " + "".join(name + self.waitingTime(now, joinTime) + status
+                for name, joinTime, status in queued)
+        outbox.reply(channel, msg)
         
-        if self._afk:
-            namesbytime = sorted(self._afk, key = lambda item: item["joinTime"])
-            msg = "^3Away^7 >> "
-            for item in namesbytime:
-                diff = datetime.datetime.now() - item["joinTime"]
-                seconds = diff.days * 3600 * 24
-                seconds = seconds + diff.seconds
-                minutes = seconds // 60
-                waiting_time = ""
-                if minutes:
-                    waiting_time = "^1{}m^7".format(minutes)
-                else:
-                    waiting_time = "^1{}s^7".format(seconds)
-                
-                msg += item["name"] + ": " + waiting_time + " "
-            
-            channel.reply(msg)
+        if away:
+            msg = "^3Away^7 >> " + "".join(name + self.waitingTime(now, joinTime) + status
+                for name, joinTime, status in away)
+            outbox.reply(channel, msg)
     
+    @perf.timed
     def cmd_afk(self, player, msg, channel):
         if len(msg) > 1:
             if self.db.has_permission(player, self.get_cvar("qlx_queueSetAfkPermission", int)):
                 guy = self.find_player(msg[1])[0]
                 if self.setAFK(guy):
                     self.setAFKTag(guy)
-                    player.tell("^7Status for {} has been set to ^3AFK^7.".format(guy.name))
+                    outbox.tell(player, "^7Status for {} has been set to ^3AFK^7.".format(guy.name))
                     return minqlx.RET_STOP_ALL
                 else:
-                    player.tell("Couldn't set status for {} to AFK.".format(guy.name))
+                    outbox.tell(player, "Couldn't set status for {} to AFK.".format(guy.name))
                     return minqlx.RET_STOP_ALL
         if self.setAFK(player):
             self.setAFKTag(player)
-            player.tell("^7Your status has been set to ^3AFK^7.")
+            outbox.tell(player, "^7Your status has been set to ^3AFK^7.")
         else:
-            player.tell("^7Couldn't set your status to AFK.")
+            outbox.tell(player, "^7Couldn't set your status to AFK.")
 
+    @perf.timed
     def cmd_playing(self, player, msg, channel):
         if self.setPlaying(player):
             self.clAFKTag(player)
-            player.tell("^7Your status has been set to ^2AVAILABLE^7.")
+            outbox.tell(player, "^7Your status has been set to ^2AVAILABLE^7.")
         else:
-            player.tell("^7Couldn't set your status to AVAILABLE.")
+            outbox.tell(player, "^7Couldn't set your status to AVAILABLE.")
+    
+    @perf.timed
+    def cmd_autofill(self, player, msg, channel):
+        if len(msg) > 1 and msg[1].lower() in ("on", "off"):
+            self.set_cvar("qlx_queueAutoFill", "1" if msg[1].lower() == "on" else "0")
+        
+        avg = self.slotIdleTotal / self.slotsFilled if self.slotsFilled else 0
+        outbox.reply(channel, "^7Auto-fill is {}. Slots filled: ^1{}^7 ({} automatically), idle ^1{:.1f}s^7 on average, ^1{:.1f}s^7 at most.".format(
+            "^2on^7" if self.get_cvar("qlx_queueAutoFill", int) else "^1off^7",
+            self.slotsFilled, self.slotsAutoFilled, avg, self.slotIdleMax))
@@ -0,0 +1,123 @@
+# This is an extension plugin  for minqlx.
+# Copyright (C) 2016 mattiZed (github) aka mattiZed (ql)
+
+# You can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, 
+# either version 3 of the License, or (at your option) any later version.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlx. If not, see <http://www.gnu.org/licenses/>.
+
+# This plugin records the hook traffic of a live server so it can be replayed
+# offline against the other plugins (see benchmarks/replay.py).
+
+# While loaded, every connect, disconnect, team switch, kill, configstring
+# change, round event, game end and chat command is appended to a gzipped
+# JSON lines file in qlx_recorderPath, one [time, frame, event, args...] array
+# per line. The hooks only put a tuple into a buffer; a background thread
+# appends the buffer to the file every qlx_recorderFlushInterval seconds.
+
+import minqlx
+import collections
+import gzip
+import json
+import os
+import threading
+import time
+
+from . import roster
+
+class recorder(minqlx.Plugin):
+    def __init__(self):
+        self.add_hook("frame", self.handle_frame, priority=minqlx.PRI_HIGHEST)
+        self.add_hook("player_connect", self.handle_player_connect, priority=minqlx.PRI_HIGHEST)
+        self.add_hook("player_disconnect", self.handle_player_disconnect, priority=minqlx.PRI_HIGHEST)
+        self.add_hook("team_switch", self.handle_team_switch, priority=minqlx.PRI_HIGHEST)
+        self.add_hook("kill", self.handle_kill, priority=minqlx.PRI_HIGHEST)
+        self.add_hook("set_configstring", self.handle_configstring, priority=minqlx.PRI_HIGHEST)
+        self.add_hook("round_countdown", self.handle_round_countdown, priority=minqlx.PRI_HIGHEST)
+        self.add_hook("round_start", self.handle_round_start, priority=minqlx.PRI_HIGHEST)
+        self.add_hook("round_end", self.handle_round_end, priority=minqlx.PRI_HIGHEST)
+        self.add_hook("game_end", self.handle_game_end, priority=minqlx.PRI_HIGHEST)
+        self.add_hook("chat", self.handle_chat, priority=minqlx.PRI_HIGHEST)
+        self.add_hook("unload", self.handle_unload)
+        roster.hook(self)
+        
+        # Directory the recordings are written to
+        self.set_cvar_once("qlx_recorderPath", "recordings")
+        self.set_cvar_once("qlx_recorderFlushInterval", "2")
+        
+        self._buffer = collections.deque()
+        self._frame = 0
+        self._start = time.monotonic()
+        self._stop = threading.Event()
+        
+        path = self.get_cvar("qlx_recorderPath")
+        os.makedirs(path, exist_ok=True)
+        self.path = os.path.join(path, time.strftime("hooks-%Y%m%d-%H%M%S.jsonl.gz"))
+        
+        # Start with the players that are on the server already.
+        for p in roster.get().players:
+            self.record("connect", p.steam_id, p.name, p.id)
+            if p.team != "spectator":
+                self.record("team", p.steam_id, p.team)
+        self.writer()
+    
+    def record(self, *event):
+        self._buffer.append((time.monotonic() - self._start, self._frame) + event)
+    
+    @minqlx.thread
+    def writer(self):
+        while not self._stop.wait(self.get_cvar("qlx_recorderFlushInterval", float)):
+            self.write()
+        self.write()
+    
+    def write(self):
+        lines = []
+        while self._buffer:
+            event = self._buffer.popleft()
+            lines.append(json.dumps([round(event[0], 4)] + list(event[1:]), separators=(",", ":")))
+        if lines:
+            # Every batch is a complete gzip member, so the recording stays
+            # readable if the server dies.
+            with gzip.open(self.path, "at") as f:
+                f.write("\n".join(lines) + "\n")
+    
+    def handle_unload(self, plugin):
+        if plugin == self.__class__.__name__:
+            self._stop.set()
+    
+    def handle_frame(self):
+        self._frame += 1
+    
+    def handle_player_connect(self, player):
+        self.record("connect", player.steam_id, player.name, player.id)
+    
+    def handle_player_disconnect(self, player, reason):
+        self.record("disconnect", player.steam_id)
+    
+    def handle_team_switch(self, player, old_team, new_team):
+        self.record("team", player.steam_id, new_team)
+    
+    def handle_kill(self, victim, killer, data):
+        if killer:
+            self.record("kill", victim.steam_id, killer.steam_id, data["MOD"])
+    
+    def handle_configstring(self, index, value):
+        self.record("configstring", index, value)
+    
+    def handle_round_countdown(self, round_number):
+        self.record("round_countdown", round_number)
+    
+    def handle_round_start(self, round_number):
+        self.record("round_start", round_number)
+    
+    def handle_round_end(self, round_number):
+        self.record("round_end", round_number)
+    
+    def handle_game_end(self, data):
+        self.record("game_end")
+    
+    def handle_chat(self, player, msg, channel):
+        if msg.startswith(self.get_cvar("qlx_commandPrefix") or "!"):
+            self.record("command", player.steam_id, msg)
@@ -0,0 +1,84 @@
+# This is a helper module for the plugins in this repository, not a plugin.
+# Copyright (C) 2016 mattiZed (github) aka mattiZed (ql)
+
+# You can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, 
+# either version 3 of the License, or (at your option) any later version.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlx. If not, see <http://www.gnu.org/licenses/>.
+
+# Every call to teams() or players() asks the engine for all players and
+# builds new Player objects. This module builds the roster once per server
+# frame and lets all plugins share it. It is thrown away on the next frame and
+# whenever somebody connects, disconnects or switches teams, which is why
+# every plugin using it hooks invalidate() to those events:
+
+#   from . import roster
+#   roster.hook(self)
+#   teams = roster.get().teams
+
+# A player who is disconnecting is still listed by the server until the next
+# frame, so they are left out of rosters built during their player_disconnect.
+
+# stats counts how often the plugins asked for the roster ("requests", which
+# used to be one engine call each) and how often it was really built.
+
+import minqlx
+
+# Events that change the roster
+EVENTS = ("player_connect", "player_disconnect", "team_switch")
+
+stats = {"requests": 0, "builds": 0}
+
+class snapshot():
+    __slots__ = ("players", "teams", "by_steam_id", "by_slot")
+    
+    def __init__(self, players):
+        self.players = players
+        self.teams = minqlx.Plugin.teams(players)
+        self.by_steam_id = {p.steam_id: p for p in players}
+        self.by_slot = [None] * 64
+        for p in players:
+            self.by_slot[p.id] = p
+
+_current = None
+# steam_ids of players disconnecting in this frame
+_leaving = set()
+
+def get():
+    '''Returns the roster of the current frame, building it if needed.'''
+    global _current
+    stats["requests"] += 1
+    if _current is None:
+        stats["builds"] += 1
+        players = minqlx.Plugin.players()
+        if _leaving:
+            players = [p for p in players if p.steam_id not in _leaving]
+        _current = snapshot(players)
+        _expire()
+    return _current
+
+def invalidate(*args):
+    '''Drops the current roster. Takes any arguments so it can be hooked.'''
+    global _current
+    _current = None
+
+def leaving(player, reason):
+    '''Drops the current roster and leaves player out until the next frame.'''
+    _leaving.add(player.steam_id)
+    invalidate()
+    _expire()
+
+def hook(plugin):
+    '''Hooks invalidate() to the roster changing events of plugin.'''
+    for event in EVENTS:
+        if event == "player_disconnect":
+            plugin.add_hook(event, leaving, priority=minqlx.PRI_HIGHEST)
+        else:
+            plugin.add_hook(event, invalidate, priority=minqlx.PRI_HIGHEST)
+
+@minqlx.next_frame
+def _expire():
+    _leaving.clear()
+    invalidate()
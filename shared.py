@@ -0,0 +1,177 @@
+# This is a helper module for the plugins in this repository, not a plugin.
+# Copyright (C) 2016 mattiZed (github) aka mattiZed (ql)
+
+# You can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, 
+# either version 3 of the License, or (at your option) any later version.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlx. If not, see <http://www.gnu.org/licenses/>.
+
+# Several servers can share one REDIS, so a value a plugin keeps in memory may
+# be changed by another server meanwhile. cache keeps such local copies with
+# hit/miss statistics and treats them as stale max_age seconds after they were
+# fetched. Servers writing a key tell the others with publish(), which adds a
+# message to the pipeline doing the write; listen() runs a thread receiving
+# those messages (and REDIS keyspace notifications, for keys written by
+# somebody who doesn't publish) and hands the keys to a callback, which
+# usually invalidates them:
+
+#   from . import shared
+#   self._values = shared.cache(max_age=60)
+#   shared.listen(self.db, self.handle_invalidation, self._stop, ("minqlx:players:*:clantag",))
+#   ...
+#   shared.publish(pipe, keys)
+
+# Keyspace notifications have to be enabled on the REDIS server for the
+# patterns to receive anything, e.g. "notify-keyspace-events K$".
+
+import minqlx
+import collections
+import os
+import socket
+import time
+
+# Channel the servers publish changed keys on
+CHANNEL = "minqlx:invalidate"
+# Identifies this server in its own messages, so it can skip them
+ORIGIN = "{}:{}".format(socket.gethostname(), os.getpid())
+
+class cache():
+    '''
+    Local copies of REDIS values. Entries that were invalidated or, with
+    max_age set, fetched longer ago than that are reported as stale by
+    missing(). With max_size set, the least recently fetched entries are
+    evicted first.
+    '''
+    __slots__ = ("_values", "_fetched", "max_age", "max_size", "stats")
+    
+    def __init__(self, max_age=None, max_size=None):
+        self._values = collections.OrderedDict()
+        self._fetched = {}
+        self.max_age = max_age
+        self.max_size = max_size
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "invalidated": 0, "evicted": 0}
+    
+    def __contains__(self, key):
+        return key in self._values
+    
+    def __iter__(self):
+        return iter(list(self._values))
+    
+    def __len__(self):
+        return len(self._values)
+    
+    def __getitem__(self, key):
+        return self._values[key]
+    
+    def __setitem__(self, key, value):
+        '''Changes a cached value locally, keeping the time it was fetched.'''
+        if key not in self._values:
+            self.put(key, value)
+        else:
+            self._values[key] = value
+    
+    def __delitem__(self, key):
+        del self._values[key]
+        del self._fetched[key]
+    
+    def get(self, key, default=None):
+        '''Returns the cached value of key, counting a hit or a miss.'''
+        if key in self._values:
+            self.stats["hits"] += 1
+            return self._values[key]
+        self.stats["misses"] += 1
+        return default
+    
+    def peek(self, key, default=None):
+        '''Like get(), but not counted.'''
+        return self._values.get(key, default)
+    
+    def put(self, key, value):
+        '''Stores a value just fetched from REDIS.'''
+        self._values[key] = value
+        self._values.move_to_end(key)
+        self._fetched[key] = time.monotonic()
+        if self.max_size is not None:
+            while len(self._values) > self.max_size:
+                del self._fetched[self._values.popitem(last=False)[0]]
+                self.stats["evicted"] += 1
+    
+    def missing(self, keys, count=True):
+        '''
+        Returns the keys that are not cached and the keys that are stale,
+        counting hits, misses and stale entries unless count is False (e.g.
+        for a prefetch, which isn't a lookup).
+        '''
+        now = time.monotonic()
+        absent, stale = [], []
+        for key in keys:
+            if key not in self._values:
+                absent.append(key)
+            elif self._fetched[key] is None or (self.max_age is not None and now - self._fetched[key] > self.max_age):
+                stale.append(key)
+            elif count:
+                self.stats["hits"] += 1
+        if count:
+            self.stats["misses"] += len(absent)
+            self.stats["stale"] += len(stale)
+        return absent, stale
+    
+    def invalidate(self, key):
+        '''Marks key as stale because it was changed somewhere else. The old
+        value stays available until it is fetched again.
+        '''
+        if key in self._values:
+            self._fetched[key] = None
+            self.stats["invalidated"] += 1
+    
+    def clear(self):
+        '''Drops all entries and resets the statistics.'''
+        self._values.clear()
+        self._fetched.clear()
+        for name in self.stats:
+            self.stats[name] = 0
+    
+    def demote(self, key):
+        '''Makes key the first to be evicted.'''
+        if key in self._values:
+            self._values.move_to_end(key, last=False)
+    
+    def ratio(self):
+        '''Share of lookups answered from the cache.'''
+        total = self.stats["hits"] + self.stats["misses"] + self.stats["stale"]
+        return self.stats["hits"] / total if total else 0.0
+
+def publish(pipe, keys):
+    '''Adds a message telling the other servers that keys changed to pipe.'''
+    if keys:
+        pipe.publish(CHANNEL, "\n".join([ORIGIN] + [str(key) for key in keys]))
+
+@minqlx.thread
+def listen(db, callback, stop, patterns=()):
+    '''
+    Calls callback(key) for every key another server published as changed
+    and every key matching one of patterns that REDIS reports as written,
+    until stop is set.
+    '''
+    pubsub = db.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(CHANNEL)
+    for pattern in patterns:
+        pubsub.psubscribe("__keyspace@*__:" + pattern)
+    try:
+        while not stop.is_set():
+            message = pubsub.get_message(timeout=1.0)
+            if not message:
+                continue
+            if message["type"] == "pmessage":
+                # The channel is "__keyspace@<db>__:<key>".
+                callback(message["channel"].split(":", 1)[1])
+                continue
+            keys = message["data"].split("\n")
+            if keys[0] == ORIGIN:
+                continue
+            for key in keys[1:]:
+                callback(key)
+    finally:
+        pubsub.close()
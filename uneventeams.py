@@ -20,54 +20,277 @@
 # slays or move to spectators the player who was in-game the shortest 
 # on event round_start.
 
-# I wrote a little timer module that can be used to start and stop timers.
-# If a timer was stopped yet not cleared 
-# (therefore you'd have to reinstantiate the object) 
-# the modules' .start() method just resumes the timer.
+# The playtimes registry below keeps a timer for every player that can be
+# started and stopped. If a timer was stopped yet not reset, .start() just
+# resumes it.
 
-# .elapsed() tells how many seconds have passed since the timer was
-# _started_for_the_first_time_, no matter if it is paused or running.
+# .elapsed() tells how many seconds the timer has been running since it was
+# added or reset, no matter if it is paused or running.
+
+# With qlx_unevenTeamsPersist set to 1 the playtimes are saved to REDIS
+# at the end of every round and game, and loaded again when a player connects
+# or the plugin is loaded, so reloads and restarts don't reset them.
 
 # Please consider this a very early version and highly experimental. 
 # I haven't tested it that much yet because testing these things is hard...
 
 import minqlx
-import datetime
+import array
+import heapq
+import itertools
 import time
 import threading
 
-class timer():
-    def __init__(self, running=False):
-        self._started = None
-        self._running = False
-        self._elapsed = 0
-        if running:
-            self.start()
-    
-    def start(self):
-        if self._running:
-            return
+from . import outbox
+from . import perf
+from . import roster
+
+_playtime_key = "minqlx:players:{}:playtime"
+
+class playtimes():
+    '''
+        Playtime timers by steam_id. Start times and accumulated seconds are
+        floats from time.monotonic() kept in arrays, so sub-second parts
+        are never dropped and wall clock adjustments don't matter.
+        
+        Every team also has two heaps ordering its players by playtime, one
+        for stopped timers (keyed by playtime) and one for running timers
+        (keyed by playtime - start, which orders them the same way at any
+        moment). Each start, stop or team change pushes a new entry; older
+        entries of that timer become stale and are skipped.
+    '''
+    __slots__ = ("_index", "_free", "_started", "_elapsed", "_teams", "_joined",
+                 "_version", "_heaps", "_joins", "_versions")
+    
+    # _started value of a timer that is not running
+    STOPPED = -1.0
+    
+    def __init__(self):
+        # { steam_id : position in the arrays }
+        self._index = {}
+        self._free = []
+        self._started = array.array("d")
+        self._elapsed = array.array("d")
+        self._teams = []
+        # Order in which the players joined their current team
+        self._joined = array.array("q")
+        # Version of the timer's only live heap entry, 0 if removed
+        self._version = array.array("Q")
+        # { team : (running heap, stopped heap) }
+        self._heaps = {}
+        self._joins = itertools.count()
+        self._versions = itertools.count(1)
+    
+    def __contains__(self, steam_id):
+        return steam_id in self._index
+    
+    def __iter__(self):
+        return iter(list(self._index))
+    
+    def __len__(self):
+        return len(self._index)
+    
+    def _live(self, entry):
+        i = self._index.get(entry[3])
+        return i is not None and self._version[i] == entry[2]
+    
+    def _push(self, i, steam_id):
+        version = next(self._versions)
+        self._version[i] = version
+        heaps = self._heaps.setdefault(self._teams[i], ([], []))
+        if self._started[i] == self.STOPPED:
+            heap, key = heaps[1], self._elapsed[i]
+        else:
+            heap, key = heaps[0], self._elapsed[i] - self._started[i]
+        heapq.heappush(heap, (key, -self._joined[i], version, steam_id))
+        
+        if len(heap) > 2 * len(self._index) + 16:
+            heap[:] = [entry for entry in heap if self._live(entry)]
+            heapq.heapify(heap)
+    
+    def add(self, steam_id, team="spectator"):
+        '''
+            Adds a stopped timer for steam_id, resetting an existing one.
+        '''
+        i = self._index.get(steam_id)
+        if i is None:
+            if self._free:
+                i = self._free.pop()
+                self._teams[i] = team
+            else:
+                i = len(self._started)
+                self._started.append(self.STOPPED)
+                self._elapsed.append(0.0)
+                self._teams.append(team)
+                self._joined.append(0)
+                self._version.append(0)
+            self._joined[i] = next(self._joins)
+            self._index[steam_id] = i
+        self._started[i] = self.STOPPED
+        self._elapsed[i] = 0.0
+        self._push(i, steam_id)
+    
+    def remove(self, steam_id):
+        i = self._index.pop(steam_id, None)
+        if i is not None:
+            self._version[i] = 0
+            self._free.append(i)
+    
+    def team(self, steam_id):
+        return self._teams[self._index[steam_id]]
+    
+    def set_team(self, steam_id, team):
+        i = self._index[steam_id]
+        if self._teams[i] != team:
+            self._teams[i] = team
+            self._joined[i] = next(self._joins)
+            self._push(i, steam_id)
+    
+    def start(self, steam_id, now=None):
+        i = self._index[steam_id]
+        if self._started[i] == self.STOPPED:
+            self._started[i] = time.monotonic() if now is None else now
+            self._push(i, steam_id)
+    
+    def stop(self, steam_id, now=None):
+        i = self._index[steam_id]
+        if self._started[i] != self.STOPPED:
+            self._elapsed[i] += (time.monotonic() if now is None else now) - self._started[i]
+            self._started[i] = self.STOPPED
+            self._push(i, steam_id)
+    
+    def credit(self, steam_id, seconds):
+        '''
+            Adds seconds of playtime, e.g. restored from the database.
+        '''
+        i = self._index[steam_id]
+        self._elapsed[i] += seconds
+        self._push(i, steam_id)
+    
+    def running(self, steam_id):
+        return self._started[self._index[steam_id]] != self.STOPPED
+    
+    def elapsed(self, steam_id, now=None):
+        i = self._index[steam_id]
+        if self._started[i] == self.STOPPED:
+            return self._elapsed[i]
+        return self._elapsed[i] + (time.monotonic() if now is None else now) - self._started[i]
+    
+    def start_many(self, steam_ids, now=None):
+        '''
+            Starts all timers at the very same moment, e.g. for a whole team.
+        '''
+        if now is None:
+            now = time.monotonic()
+        for steam_id in steam_ids:
+            self.start(steam_id, now)
+    
+    def stop_many(self, steam_ids, now=None):
+        if now is None:
+            now = time.monotonic()
+        for steam_id in steam_ids:
+            self.stop(steam_id, now)
+    
+    def least(self, team, tiebreak=None):
+        '''
+            Returns the steam_id with the least playtime in team, or None.
+            Ties go to the player who joined the team last, or, if tiebreak is
+            given, to the lowest tiebreak(steam_id) first.
+        '''
+        now = time.monotonic()
+        best, tied = None, []
+        for heap, offset in zip(self._heaps.get(team, ((), ())), (now, 0.0)):
+            while heap and not self._live(heap[0]):
+                heapq.heappop(heap)
+            if not heap:
+                continue
             
-        self._started = datetime.datetime.now()
-        self._running = True
+            top = [heap[0]]
+            if tiebreak is not None:
+                top = [heapq.heappop(heap)]
+                while heap and heap[0][0] == top[0][0]:
+                    entry = heapq.heappop(heap)
+                    if self._live(entry):
+                        top.append(entry)
+                for entry in top:
+                    heapq.heappush(heap, entry)
+            
+            elapsed = top[0][0] + offset
+            if best is None or elapsed < best:
+                best, tied = elapsed, top
+            elif elapsed == best:
+                tied += top
         
-    def stop(self):
-        if not self._started or not self._running:
+        if not tied:
+            return None
+        if tiebreak is None:
+            return min(tied, key=lambda entry: entry[1])[3]
+        return min(tied, key=lambda entry: (tiebreak(entry[3]), entry[1]))[3]
+    
+    def ordered(self, team):
+        '''
+            Returns [(steam_id, playtime)] of team, least playtime first.
+        '''
+        now = time.monotonic()
+        res = []
+        for heap, offset in zip(self._heaps.get(team, ((), ())), (now, 0.0)):
+            res.extend((entry[0] + offset, entry[1], entry[3]) for entry in heap if self._live(entry))
+        res.sort()
+        return [(steam_id, elapsed) for elapsed, _, steam_id in res]
+
+class task():
+    __slots__ = ("deadline", "func", "args", "cancelled")
+    
+    def __init__(self, deadline, func, args):
+        self.deadline = deadline
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+class scheduler():
+    '''
+        Delayed callbacks without a sleeping thread each: deadlines are kept in
+        a heap and run_due(), called from the plugin's frame hook, runs the
+        callbacks that are due on the game thread.
+    '''
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self.pending = 0
+    
+    def call_later(self, delay, func, *args):
+        '''
+            Runs func(*args) on the first frame after delay seconds. Returns
+            the task, which can be passed to cancel().
+        '''
+        t = task(time.monotonic() + delay, func, args)
+        with self._lock:
+            heapq.heappush(self._heap, (t.deadline, next(self._seq), t))
+            self.pending += 1
+        return t
+    
+    def cancel(self, t):
+        with self._lock:
+            if t and not t.cancelled:
+                t.cancelled = True
+                self.pending -= 1
+    
+    def run_due(self):
+        if not self._heap:
             return
-        stopped = datetime.datetime.now()
-        diff = stopped - self._started
-        self._elapsed += diff.seconds
-        self._running = False
-    
-    def elapsed(self):
-        if self._running:
-            now = datetime.datetime.now()
-            diff = now - self._started
-            self._elapsed += diff.seconds
-            self._started = now
-            return self._elapsed
-        else:
-            return self._elapsed
+        
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                if not self._heap or self._heap[0][0] > now:
+                    return
+                t = heapq.heappop(self._heap)[2]
+                if t.cancelled:
+                    continue
+                t.cancelled = True
+                self.pending -= 1
+            t.func(*t.args)
 
 class uneventeams(minqlx.Plugin):
     def __init__(self):
@@ -78,31 +301,156 @@ class uneventeams(minqlx.Plugin):
         self.add_hook("round_end", self.handle_round_end)
         self.add_hook("round_countdown", self.handle_round_countdown)
         self.add_hook("game_end", self.handle_game_end)
+        self.add_hook("frame", self.handle_frame)
         self.add_command("playertimes", self.cmd_playertimes, 2)
+        roster.hook(self)
+        perf.track(self)
         
-        # { steam_id : time_played }
-        self._players = {}
-        
-        self.initialize()
+        # steam_id -> time played
+        self._players = playtimes()
+        self._tasks = scheduler()
+        # { steam_id : task } of deferred_removing
+        self._removals = {}
+        # Who is connected, kept up to date by the connect/disconnect events.
+        # The generation of a client slot changes whenever its player does.
+        self._slots = [None] * 64
+        self._generation = [0] * 64
+        # { steam_id : (slot, generation) }
+        self._online = {}
+        # { steam_id : playtime } of players that left since the last checkpoint
+        self._departed = {}
         
         # Slay (0) or move to spectators (1) when teams are uneven
         self.set_cvar_once("qlx_unevenTeamsAction", "0")
         # Minimum amount of players in red + blue for uneventeams to work
         self.set_cvar_once("qlx_unevenTeamsMinPlayers", "2")
+        # Among equal playtimes pick who joined last (0) or the lowest score (1)
+        self.set_cvar_once("qlx_unevenTeamsTieBreak", "0")
+        # Keep playtimes in REDIS (1) and for how many seconds after the last save
+        self.set_cvar_once("qlx_unevenTeamsPersist", "0")
+        self.set_cvar_once("qlx_unevenTeamsPersistTTL", "3600")
+        
+        self.initialize()
         
     def initialize(self):
         '''
             Equip all players with timers on plugin load.
         '''
-        players = self.teams()
+        players = roster.get().players
+        for p in players:
+            self.track(p)
+        self.restore(players)
+    
+    def track(self, player):
+        '''
+            Marks player as connected in their client slot and makes sure
+            there is a timer for them.
+        '''
+        sid = player.steam_id
+        if self._online.get(sid, (None,))[0] != player.id:
+            self.release(sid)
+            self._generation[player.id] += 1
+            self._slots[player.id] = sid
+            self._online[sid] = (player.id, self._generation[player.id])
+        if sid not in self._players:
+            self._players.add(sid, player.team)
+    
+    def release(self, steam_id):
+        '''
+            Frees the client slot steam_id was indexed in.
+        '''
+        slot = self._online.pop(steam_id, (None,))[0]
+        if slot is not None and self._slots[slot] == steam_id:
+            self._generation[slot] += 1
+            self._slots[slot] = None
+    
+    def untrack(self, steam_id):
+        '''
+            Forgets a player that left, together with their timer.
+        '''
+        if self.persist() and steam_id in self._players:
+            self._departed[steam_id] = self._players.elapsed(steam_id)
+        self.release(steam_id)
+        self._tasks.cancel(self._removals.pop(steam_id, None))
+        self._players.remove(steam_id)
+    
+    def check_consistency(self, players=None):
+        '''
+            Compares the connection index with a roster (the real one by
+            default) and returns a list of the differences found.
+        '''
+        if players is None:
+            players = roster.get().players
+        problems = []
+        connected = {}
+        for p in players:
+            connected[p.steam_id] = p
+            if self._online.get(p.steam_id, (None,))[0] != p.id:
+                problems.append("{} is not indexed in slot {}".format(p.steam_id, p.id))
+            elif self._slots[p.id] != p.steam_id:
+                problems.append("slot {} does not point to {}".format(p.id, p.steam_id))
+            if p.steam_id not in self._players:
+                problems.append("{} has no timer".format(p.steam_id))
+            elif self._players.team(p.steam_id) != p.team:
+                problems.append("{} is indexed in the wrong team".format(p.steam_id))
+        for sid in self._online:
+            if sid not in connected:
+                problems.append("{} is indexed but not connected".format(sid))
+        for sid in self._players:
+            if sid not in connected:
+                problems.append("{} has a timer but is not connected".format(sid))
+        for slot, sid in enumerate(self._slots):
+            if sid is not None and (sid not in connected or connected[sid].id != slot):
+                problems.append("slot {} is stale".format(slot))
+        return problems
+    
+    ## Persistence
+    def persist(self):
+        return self.get_cvar("qlx_unevenTeamsPersist", int) == 1
+    
+    def checkpoint(self):
+        '''
+            Saves everybody's playtime, including players who left since the
+            last checkpoint, as a single pipelined batch.
+        '''
+        if not self.persist():
+            return
         
-        for p in players["red"]:
-            self._players[p.steam_id] = timer()
-        for p in players["blue"]:
-            self._players[p.steam_id] = timer()
-        for p in players["spectator"]:
-            self._players[p.steam_id] = timer()
+        now = time.monotonic()
+        values, self._departed = self._departed, {}
+        for sid in self._players:
+            values[sid] = self._players.elapsed(sid, now)
+        self.save(values, self.get_cvar("qlx_unevenTeamsPersistTTL", int))
+    
+    @minqlx.thread
+    def save(self, values, ttl):
+        pipe = self.db.pipeline(transaction=False)
+        for sid, elapsed in values.items():
+            pipe.set(_playtime_key.format(sid), "{:.3f}".format(elapsed), ex=ttl)
+        pipe.execute()
     
+    def restore(self, players):
+        '''
+            Loads the saved playtime of players in the background.
+        '''
+        if self.persist() and players:
+            self.load([(p.steam_id,) + self._online[p.steam_id] for p in players])
+    
+    @minqlx.thread
+    def load(self, players):
+        pipe = self.db.pipeline(transaction=False)
+        for sid, slot, generation in players:
+            pipe.get(_playtime_key.format(sid))
+        self.credit(players, pipe.execute())
+    
+    @minqlx.next_frame
+    def credit(self, players, values):
+        for (sid, slot, generation), value in zip(players, values):
+            # Skip players that left while we were waiting for the database.
+            if value and self._generation[slot] == generation:
+                self._players.credit(sid, float(value))
+    
+    @perf.timed
     def handle_round_countdown(self, round_number):
         '''
             Check if teams are uneven and if so, warn the player with the 
@@ -110,7 +458,7 @@ class uneventeams(minqlx.Plugin):
         '''
         min_players = self.get_cvar("qlx_unevenTeamsMinPlayers", int)
         
-        teams = self.teams()
+        teams = roster.get().teams
         
         if len(teams["red"]) == len(teams["blue"]):
             return
@@ -118,11 +466,12 @@ class uneventeams(minqlx.Plugin):
             return
         
         if len(teams["red"]) > len(teams["blue"]):
-            guy = self.player(self.find_lastjoined("red"))
+            guy = roster.get().by_steam_id[self.find_lastjoined("red")]
         else:
-            guy = self.player(self.find_lastjoined("blue"))
-        self.msg("^1Uneven Teams^7 >> {}^7 joined last and should spectate".format(guy.name))
+            guy = roster.get().by_steam_id[self.find_lastjoined("blue")]
+        outbox.msg("^1Uneven Teams^7 >> {}^7 joined last and should spectate".format(guy.name))
     
+    @perf.timed
     def handle_round_start(self, round_number):
         '''
             Start (or resume) the timers for the players in RED and BLUE.
@@ -131,19 +480,9 @@ class uneventeams(minqlx.Plugin):
         min_players = self.get_cvar("qlx_unevenTeamsMinPlayers", int)
         action = self.get_cvar("qlx_unevenTeamsAction", int)
         
-        teams = self.teams()
+        teams = roster.get().teams
         
-        for p in teams["red"]:
-            self._players[p.steam_id].start()
-        
-        for p in teams["blue"]:
-            self._players[p.steam_id].start()
-        
-        for p in self._players.keys():
-            try: 
-                self.player(p)
-            except:
-                del self._players[p]
+        self._players.start_many([p.steam_id for p in teams["red"] + teams["blue"]])
         
         if len(teams["red"]) == len(teams["blue"]):
             return
@@ -151,115 +490,117 @@ class uneventeams(minqlx.Plugin):
             return
         
         if len(teams["red"]) > len(teams["blue"]):
-            guy = self.player(self.find_lastjoined("red"))
+            guy = roster.get().by_steam_id[self.find_lastjoined("red")]
         else:
-            guy = self.player(self.find_lastjoined("blue"))
+            guy = roster.get().by_steam_id[self.find_lastjoined("blue")]
         
         if action == 0:
             guy.health = 0
-            self.msg("^1Uneven Teams^7 >> {}^7 was slain.".format(guy.name))
+            outbox.msg("^1Uneven Teams^7 >> {}^7 was slain.".format(guy.name))
         if action == 1:
             guy.put("spectator")
-            self.msg("^1Uneven Teams^7 >> {}^7 was moved to spectators.".format(guy.name))
+            outbox.msg("^1Uneven Teams^7 >> {}^7 was moved to spectators.".format(guy.name))
         
+    @perf.timed
     def handle_round_end(self, round_number):
         '''
             The round is over, stop the players' timers.
         '''
-        teams = self.teams()
+        teams = roster.get().teams
         
-        for p in teams["red"] + teams["blue"]:
-            self._players[p.steam_id].stop()
+        self._players.stop_many([p.steam_id for p in teams["red"] + teams["blue"]])
+        self.checkpoint()
     
+    @perf.timed
     def handle_game_end(self, data):
         '''
             The game has ended for any reason. Stop all timing.
         '''
-        teams = self.teams()
-        
-        for p in teams["red"]:
-            self._players[p.steam_id].stop()
+        teams = roster.get().teams
         
-        for p in teams["blue"]:
-            self._players[p.steam_id].stop()
+        self._players.stop_many([p.steam_id for p in teams["red"] + teams["blue"]])
+        self.checkpoint()
     
+    @perf.timed
     def handle_team_switch(self, player, old_team, new_team):
         '''
             If a player joined spectators he cant gain playtime.
         '''
+        self.track(player)
+        self._players.set_team(player.steam_id, new_team)
+        
         if new_team == "spectator":
-            self._players[player.steam_id].stop()
-            self.deferred_removing(player, self._players[player.steam_id].elapsed())
+            self._players.stop(player.steam_id)
+            self.deferred_removing(player, self._players.elapsed(player.steam_id))
         
         if new_team == "red" or new_team == "blue":
-            self._players[player.steam_id].start()
+            self._tasks.cancel(self._removals.pop(player.steam_id, None))
+            self._players.start(player.steam_id)
             
+    @perf.timed
     def handle_player_disconnect(self, player, reason):
-        if player.steam_id in self._players.keys():
-            self._players[player.steam_id].stop()
-            self.deferred_removing(player, self._players[player.steam_id].elapsed())
+        self.untrack(player.steam_id)
+    
+    @perf.timed
+    def handle_frame(self):
+        self._tasks.run_due()
     
+    @perf.timed
     def handle_player_connect(self, player):
         '''
             Equip every new player with a timer instance.
         '''
-        if player.steam_id not in self._players.keys():
-            self._players[player.steam_id] = timer()
+        new = player.steam_id not in self._players
+        self.track(player)
+        if new:
+            self.restore([player])
+    
+    def perf_counters(self):
+        '''
+            Numbers shown by !perf.
+        '''
+        return {"tasks_pending": self._tasks.pending}
     
+    @perf.timed
     def cmd_playertimes(self, player, msg, channel):
         # This one is mostly for debugging.
-        teams = self.teams()
-        red_msg = ""
-        for p in teams["red"]:
-            red_msg += "^7{}:^1 {}^7s ".format(p, self._players[p.steam_id].elapsed())
+        players = roster.get().by_steam_id
         
-        blue_msg = ""
-        for p in teams["blue"]:
-            blue_msg += "^7{}:^4 {}^7s ".format(p, self._players[p.steam_id].elapsed())
-            
-        spec_msg = ""
-        for p in teams["spectator"]:
-            spec_msg += "^7{}:^7 {}^7s ".format(p, self._players[p.steam_id].elapsed())
+        def times(team, color):
+            return "".join("^7{}:{} {}^7s ".format(players[sid] if sid in players else sid, color, int(elapsed))
+                for sid, elapsed in self._players.ordered(team))
         
-        channel.reply(red_msg)
-        channel.reply(blue_msg)
-        channel.reply(spec_msg)
+        outbox.reply(channel, times("red", "^1"))
+        outbox.reply(channel, times("blue", "^4"))
+        outbox.reply(channel, times("spectator", "^7"))
+        outbox.reply(channel, "^7{} delayed tasks pending.".format(self._tasks.pending))
     
     def find_lastjoined(self, team):
         '''
             Find the player with the least amount of time played.
         '''
-        teams = self.teams()
-        if team == "red":
-            players = teams["red"]
-        else:
-            players = teams["blue"]
-            
-        bigger_team = {}
-        for p in players:
-            bigger_team[p.steam_id] = self._players[p.steam_id].elapsed()
-            
-        namesbytime = sorted(bigger_team, key = lambda item: bigger_team[item])
-        return namesbytime[0]
+        tiebreak = None
+        if self.get_cvar("qlx_unevenTeamsTieBreak", int) == 1:
+            players = roster.get().by_steam_id
+            tiebreak = lambda steam_id: players[steam_id].score
+        
+        return self._players.least(team, tiebreak)
         
-    @minqlx.thread
     def deferred_removing(self, player, old_elapsed):
         '''
             Deffered removing player timer after 180 seconds
             or resetting it if player didn't joined teams, and currently spectating
         '''
-        @minqlx.next_frame
-        def removing():
-            players = self.teams()["red"] + self.teams()["blue"] + self.teams()["spectator"]
-            
-            if player in players:
-                if self._players[player.steam_id].elapsed() == old_elapsed:
-                    self._players[player.steam_id] = timer()
-            else:
-                del self._players[player.steam_id]
-            
-        
-        time.sleep(180)
+        self._tasks.cancel(self._removals.get(player.steam_id))
+        slot, generation = self._online[player.steam_id]
+        self._removals[player.steam_id] = self._tasks.call_later(180, self.removing, player, old_elapsed, slot, generation)
+    
+    def removing(self, player, old_elapsed, slot, generation):
+        del self._removals[player.steam_id]
         
-        if player.steam_id in self._players.keys():
-            removing()
\ No newline at end of file
+        # Departed players were dropped on disconnect already, a changed
+        # generation just means this task outlived its player.
+        if self._generation[slot] != generation:
+            return
+        if self._players.elapsed(player.steam_id) == old_elapsed:
+            self._players.add(player.steam_id)
\ No newline at end of file